@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# Benchmarks for niconico-to-ass.py on synthetic comment files
+#
+# Every scenario is a comment XML file generated from a seed, so runs are
+# comparable across versions. Each pipeline stage is timed separately, the
+# output is checked against that of the original converter, the baseline
+# revision, given the same text sizes (so that optimizations are known to
+# keep the output identical), and the timings are appended to a results
+# file and compared with the previous run.
+#
+# Run it where the fonts are, as with niconico-to-ass.py itself (the
+# baseline also needs pytz, and is much slower on large scenarios, but its
+# digests are kept in the data directory):
+#     python3 benchmark.py --scale 10000 100000
+#     python3 benchmark.py --scale 10000000 --bursts 0.5 --yugi 0.05
+
+import argparse, hashlib, importlib.util, io, json, os, random, subprocess, sys, timeit
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+
+# Texts by the font that VSFilter will render them in
+TEXTS = OrderedDict((
+	('Arial', ['wwww', '8888888', 'Hello world', 'GJ', 'x' * 40, 'abc\\', '{brace}']),
+	('MS PGothic', ['草', 'こんにちは', 'ｗｗｗ', 'テスト', 'きたああああああ', '弾幕薄いよ何やってんの']),
+	# Only the normal size exists for these two (see load_fonts())
+	('Segoe UI Symbol', ['⚽⛄', '☺️', '⛅']),
+	('Nirmala UI', ['नमस्ते', 'ধন্যবাদ']),
+))
+COLORS = ['red', 'green', 'blue', 'cyan', 'yellow', 'purple', 'pink', 'orange']
+PREMIUM_COLORS = ['niconicowhite', 'marineblue', 'madyellow', 'passionorange',
+                  'nobleviolet', 'elementalgreen', 'truered', 'black']
+PERM_TEXTS = ['<b>Bold</b> text<br>second line', 'plain operator text',
+              '<font color="#ff0000">red</font>&amp;', '<i>it</i>',
+              '<a href="http://example.com/">link</a>']
+# The original converter, whose output every run is checked against
+BASELINE = 'f173b27fdc4257c12aff67ad142f26a3a073e529'
+# What the baseline needs changed to run here: two bugs that newer Pythons
+# reject, where it reads the sizes from, and the order in which it tries the
+# danmaku already on screen. That was a set, so where a danmaku ended up
+# depended on memory addresses; now it is the order that lay_out() settles
+# on, from the top (or the bottom) down (or up).
+BASELINE_FIXES = [
+	('super().__init__(self, convert_charrefs=True)',
+	 'super().__init__(convert_charrefs=True)'),
+	("r'\\1\\h'", "r'\\1\\\\h'"),
+	("r'\\h\\1'", "r'\\\\h\\1'"),
+	("open('bounds.txt')", 'open(BOUNDS)'),
+	('for previous_chat in previous_chats:',
+	 "for previous_chat in sorted(previous_chats, key=lambda c: "
+	 "(-(c.y + c.height), -c.y) if chat.valign == 'bottom' "
+	 "else (c.y, c.y + c.height)):"),
+]
+
+def load_converter():
+	"""load_converter() -> module
+
+Import niconico-to-ass.py from next to this script."""
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+	                    'niconico-to-ass.py')
+	spec = importlib.util.spec_from_file_location('niconico_to_ass', path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def generate(file, count, seed=0, rate=2, bursts=0.2, burst_rate=30,
+             ue=0.08, shita=0.08, big=0.08, small=0.08, premium=0.3,
+             yugi=0.01, start_time=1484047270.09):
+	"""generate(file, count, seed=0, rate=2, bursts=0.2, burst_rate=30, ue=0.08, shita=0.08, big=0.08, small=0.08, premium=0.3, yugi=0.01, start_time=1484047270.09)
+
+Write a comment XML file with count chats to the text file object file.
+Comments arrive at rate per second, except for the fraction bursts of them
+that arrive in bursts at burst_rate per second. ue, shita, big, small and
+premium are the fractions of comments with those commands or a premium
+account (which also uses premium colors), and yugi is the fraction of
+operator comments: /perm, /clear and /vote start, showresult and stop.
+Comment texts cycle through every font in FONTS."""
+	r = random.Random(seed)
+	file.write('<?xml version="1.0" encoding="UTF-8"?>\n<packet>\n')
+	fonts = list(TEXTS)
+	time = 0
+	burst = 0
+	vote = None
+	for i in range(count):
+		if not burst and r.random() < bursts / 50:
+			burst = 50
+		if burst:
+			burst -= 1
+			time += r.expovariate(burst_rate)
+		else:
+			time += r.expovariate(rate)
+		date = round((start_time + time) * 1000000)
+		attrs = OrderedDict((
+			('thread', '1'),
+			('no', str(i + 1)),
+			('vpos', str(max(round(time * 100) - r.randrange(50), 0))),
+			('date', str(date // 1000000)),
+			('date_usec', str(date % 1000000)),
+			('user_id', 'u%d' % r.randrange(count // 10 + 1)),
+		))
+		mail = []
+		flags = 0
+		if r.random() < premium:
+			flags |= 1
+		if r.random() < yugi:
+			flags |= 2
+			kind = r.random()
+			if vote is not None and kind < 0.3:
+				if r.random() < 0.5:
+					text = '/vote showresult per ' + ' '.join(
+						str(r.randrange(1000)) for answer in range(vote))
+				else:
+					text = '/vote stop'
+					vote = None
+			elif kind < 0.3:
+				vote = r.randrange(2, 10)
+				text = '/vote start "Question %d" %s' % (
+					i, ' '.join('answer%d' % answer for answer in range(vote)))
+			elif kind < 0.4:
+				text = '/clear'
+			elif kind < 0.8:
+				text = '/perm ' + r.choice(PERM_TEXTS)
+			else:
+				text = r.choice(PERM_TEXTS)
+		else:
+			font = fonts[i % len(fonts)]
+			text = r.choice(TEXTS[font])
+			position = r.random()
+			if position < ue:
+				mail.append('ue')
+			elif position < ue + shita:
+				mail.append('shita')
+			if font in {'Arial', 'MS PGothic'}:
+				size = r.random()
+				if size < big:
+					mail.append('big')
+				elif size < big + small:
+					mail.append('small')
+			if r.random() < 0.2:
+				mail.append(r.choice(PREMIUM_COLORS if flags & 1 else COLORS))
+			if r.random() < 0.5:
+				mail.append('184')
+				attrs['anonymity'] = '1'
+		if flags:
+			attrs['premium'] = str(flags)
+		if mail:
+			attrs['mail'] = ' '.join(mail)
+		file.write('<chat %s>%s</chat>\n' %
+		           (' '.join('%s=%s' % (name, quoteattr(value))
+		                     for name, value in attrs.items()),
+		            escape(text)))
+	file.write('</packet>\n')
+
+def run(converter, path, config, measurement):
+	"""run(converter, path, config, measurement) -> (OrderedDict, str)
+
+Convert the file at path stage by stage. Return the seconds spent in each
+stage and the script."""
+	times = OrderedDict()
+	def stage(name, function, *args):
+		start = timeit.default_timer()
+		result = function(*args)
+		times[name] = timeit.default_timer() - start
+		return result
+	converter.unsupported.clear()
+	converter.unsupported_commands.clear()
+	random.seed(0)
+	output = io.StringIO()
+	sink = converter.Sink(output)
+	chats = stage('load', converter.load_chats, path, config)
+	stage('resolve_timing', converter.resolve_timing, chats)
+	cache = stage('measure', converter.measure_sizes, chats, config,
+	              measurement)
+	stage('lay_out', converter.lay_out, chats, config)
+	stage('render', converter.render, chats, config, sink, cache)
+	sink.flush()
+	times['total'] = sum(times.values())
+	return times, output.getvalue()
+
+def baseline_script(data_dir):
+	"""baseline_script(data_dir) -> str
+
+Save niconico-to-ass.py as of BASELINE, with BASELINE_FIXES, to data_dir
+and return its path. It reads the sizes from the file in its BOUNDS."""
+	path = os.path.join(data_dir, 'baseline-%s.py' % BASELINE[:12])
+	if not os.path.exists(path):
+		source = subprocess.check_output(
+			['git', 'show', BASELINE + ':niconico-to-ass.py'],
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+			universal_newlines=True)
+		for old, new in BASELINE_FIXES:
+			assert old in source, 'the baseline has changed'
+			source = source.replace(old, new)
+		with open(path + '.tmp', 'w', encoding='utf-8') as file:
+			file.write(source)
+		os.replace(path + '.tmp', path)
+	return path
+
+def write_baseline_bounds(converter, path, config, measurement, bounds):
+	"""write_baseline_bounds(converter, path, config, measurement, bounds)
+
+Measure the chats in the file at path as run() does and write their sizes
+to the file bounds, line by line in the order that the baseline reads
+them, with placeholders for the lines it skips."""
+	converter.unsupported.clear()
+	converter.unsupported_commands.clear()
+	chats = converter.load_chats(path, config)
+	converter.resolve_timing(chats)
+	converter.measure_sizes(chats, config, measurement)
+	skipped = '0 0 0\n'
+	def size(width, height):
+		return '0 %s %s\n' % (width, height)
+	with open(bounds, 'w', encoding='utf-8') as file:
+		for chat in chats:
+			if chat.command == 'vote' and chat.mode == 'stop':
+				continue
+			if chat.command == 'perm' or chat.command == 'vote' and chat.text:
+				file.write(skipped * 2)
+			if (chat.command in {None, 'perm'} or
+			    chat.command == 'vote' and chat.text):
+				file.write(size(chat.width, chat.height))
+			if chat.command == 'vote' and chat.mode != 'stop':
+				percentage_sizes = getattr(chat, 'percentage_sizes', None)
+				for i, answer_size in enumerate(chat.answer_sizes):
+					file.write(skipped * 2)
+					file.write(size(*answer_size))
+					if chat.mode == 'showresult':
+						file.write(size(*percentage_sizes[i])
+						           if percentage_sizes else skipped)
+
+def run_baseline(script, path, bounds):
+	"""run_baseline(script, path, bounds) -> str
+
+Convert the file at path with the baseline script, reading the sizes from
+the file bounds, with the same random seed as run(), and return the
+script."""
+	code = ('import random, runpy, sys; random.seed(0); '
+	        'sys.argv[1:] = [%r]; '
+	        'runpy.run_path(%r, {"BOUNDS": %r}, "__main__")'
+	        % (path, script, bounds))
+	return subprocess.check_output([sys.executable, '-c', code],
+	                               universal_newlines=True)
+
+def revision():
+	try:
+		return subprocess.check_output(
+			['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def main():
+	parser = argparse.ArgumentParser(description='Time niconico-to-ass.py '
+	                                 'on synthetic comment files.')
+	parser.add_argument('--scale', type=int, nargs='+', default=[10000],
+	                    help='numbers of comments to benchmark '
+	                         '(default: %(default)s)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--rate', type=float, default=2,
+	                    help='comments per second outside bursts')
+	parser.add_argument('--bursts', type=float, default=0.2,
+	                    help='fraction of comments that come in bursts')
+	parser.add_argument('--burst-rate', type=float, default=30,
+	                    help='comments per second in bursts')
+	for name in ('ue', 'shita', 'big', 'small'):
+		parser.add_argument('--' + name, type=float, default=0.08,
+		                    help='fraction of comments with %s' % name)
+	parser.add_argument('--premium', type=float, default=0.3,
+	                    help='fraction of comments by premium users')
+	parser.add_argument('--yugi', type=float, default=0.01,
+	                    help='fraction of operator comments')
+	parser.add_argument('--measure', choices=('freetype', 'bounds'),
+	                    default='freetype',
+	                    help='how to measure text (bounds needs a bounds '
+	                         'cache that has every text)')
+	parser.add_argument('--time-base', default='fraction')
+	parser.add_argument('--data-dir', default='benchmark-data',
+	                    help='where generated files, golden digests and '
+	                         'results are kept (default: %(default)s)')
+	args = parser.parse_args()
+
+	converter = load_converter()
+	config = converter.Config(time_base=args.time_base)
+	os.makedirs(args.data_dir, exist_ok=True)
+	golden_path = os.path.join(args.data_dir, 'golden.json')
+	results_path = os.path.join(args.data_dir, 'results.jsonl')
+	try:
+		with open(golden_path, encoding='utf-8') as file:
+			golden = json.load(file)
+	except FileNotFoundError:
+		golden = {}
+	previous = {}
+	try:
+		with open(results_path, encoding='utf-8') as file:
+			for line in file:
+				result = json.loads(line)
+				previous[result['scenario']] = result
+	except FileNotFoundError:
+		pass
+
+	failed = False
+	for count in args.scale:
+		options = OrderedDict((
+			('count', count), ('seed', args.seed), ('rate', args.rate),
+			('bursts', args.bursts), ('burst_rate', args.burst_rate),
+			('ue', args.ue), ('shita', args.shita), ('big', args.big),
+			('small', args.small), ('premium', args.premium),
+			('yugi', args.yugi),
+		))
+		scenario = ','.join('%s=%s' % item for item in options.items())
+		name = hashlib.sha1(scenario.encode('utf-8')).hexdigest()[:12]
+		path = os.path.join(args.data_dir, name + '.xml')
+		if not os.path.exists(path):
+			print('Generating %d comments...' % count, file=sys.stderr)
+			with open(path + '.tmp', 'w', encoding='utf-8') as file:
+				generate(file, **options)
+			os.replace(path + '.tmp', path)
+
+		key = '%s,measure=%s' % (scenario, args.measure)
+		# The baseline's output only depends on the sizes it is given
+		bounds = os.path.join(args.data_dir, name + '.bounds')
+		write_baseline_bounds(converter, path, config, args.measure, bounds)
+		with open(bounds, 'rb') as file:
+			golden_key = '%s,baseline=%.12s,bounds=%s' % (
+				key, BASELINE, hashlib.sha256(file.read()).hexdigest())
+		if golden_key not in golden:
+			print('Converting with the baseline...', file=sys.stderr)
+			script = run_baseline(baseline_script(args.data_dir), path,
+			                      bounds)
+			golden[golden_key] = hashlib.sha256(
+				script.encode('utf-8')).hexdigest()
+
+		times, script = run(converter, path, config, args.measure)
+		digest = hashlib.sha256(script.encode('utf-8')).hexdigest()
+		if golden[golden_key] == digest:
+			status = 'same as golden'
+		else:
+			status = 'DIFFERENT FROM GOLDEN'
+			failed = True
+
+		result = OrderedDict((
+			('scenario', key), ('revision', revision()),
+			('python', sys.version.split()[0]),
+			('time_base', args.time_base), ('seconds', times),
+			('digest', digest),
+		))
+		last = previous.get(key)
+		print('%d comments (%s), output %s:' % (count, name, status))
+		for stage, seconds in times.items():
+			line = '  %-15s %9.3f s' % (stage, seconds)
+			if last is not None and last['seconds'].get(stage):
+				line += '  %+6.1f%% vs %s' % (
+					(seconds / last['seconds'][stage] - 1) * 100,
+					last['revision'] or 'previous run')
+			print(line)
+		with open(results_path, 'a', encoding='utf-8') as file:
+			file.write(json.dumps(result) + '\n')
+
+	with open(golden_path, 'w', encoding='utf-8') as file:
+		json.dump(golden, file, indent='\t', sort_keys=True)
+	if failed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -61,38 +61,98 @@
 #     Hell, this is just turning into a plain-text syntax for SVG now!
 #     Oh wow, turns out SVG doesn't even support this stuff!
 
-import argparse, freetype, html, itertools, math, numbers, operator, os, pytz, random, re, sys
-from collections import namedtuple, OrderedDict
-from datetime import datetime
+import timeit
+_import_start = timeit.default_timer()
+
+import array, hashlib, importlib, io, itertools, math, numbers, operator, os, random, re, sys
+from collections import Counter, namedtuple, OrderedDict
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from html.parser import HTMLParser
 from fractions import Fraction
 from xml.etree import ElementTree
 
-parser = argparse.ArgumentParser()
-parser.add_argument('file', type=argparse.FileType('r'),
-                    help='NicoNico comment XML file')
-args = parser.parse_args()
+# Seconds spent importing modules and opening fonts, for --startup-report
+startup_times = OrderedDict([('import of eager modules',
+                              timeit.default_timer() - _import_start)])
+
+def _import(name):
+	"""_import(name) -> module
+
+Import a module that is only needed by some code paths, the first time
+one of them runs."""
+	module = sys.modules.get(name)
+	if module is None:
+		start = timeit.default_timer()
+		module = importlib.import_module(name)
+		startup_times['import of ' + name] = timeit.default_timer() - start
+	return module
+
+# NumPy is optional. This is False until a layout first has enough chats
+# to use it, and then the module or None if it is not installed.
+numpy = False
+
+def _import_numpy():
+	global numpy
+	if numpy is False:
+		try:
+			numpy = _import('numpy')
+		except ImportError:
+			numpy = None
+	return numpy
 
 unsupported = set()
 unsupported_commands = set()
+WARNINGS = {
+	'html': 'This file contains HTML that I cannot handle. '
+	        'It will be removed.',
+	'lone': 'This file contains lone characters without '
+	        'glyphs. Arial will be used at your peril.',
+	'fonts': 'This file contains characters not in any '
+	         'known font. Arial will be used at your peril.',
+	'braces': 'This file contains "{" in comments before font changes '
+	          'or before "}". They will appear as "\\" in VSFilter.',
+	'commands': 'This file contains commands that I cannot handle.',
+	'result_modes': 'This file contains voting result modes that I cannot '
+	                'handle. Result mode "per" will be used instead.',
+}
 
-# This is the time the video stream starts, extracted from the FLV filename
-START_TIME = round(Fraction(datetime(2017, 1, 10, 20, 40, 10, 90000, tzinfo=pytz.timezone('Asia/Tokyo')).timestamp()), 6)
+def warn(key, pending=None):
+	"""warn(key, pending=None)
+
+Print WARNINGS[key] unless it has already been printed during this
+conversion. If pending is a list, add key to it instead, so that it can
+be given later (or again, for a result that is reused)."""
+	if pending is not None:
+		if key not in pending:
+			pending.append(key)
+	elif key not in unsupported:
+		print(WARNINGS[key], file=sys.stderr)
+		unsupported.add(key)
+
+# How often the hot paths of the current conversion ran, for --profile
+counters = Counter()
+
+# This is the time the video stream starts, extracted from the FLV filename.
+# It used to be given in pytz's Asia/Tokyo, which as a tzinfo argument means
+# local mean time, so that offset (UTC+9:19) is kept here without pytz
+START_TIME = round(Fraction(datetime(2017, 1, 10, 20, 40, 10, 90000, tzinfo=timezone(timedelta(hours=9, minutes=19))).timestamp()), 6)
 PASS = 2  # when running pass 1, don't forget -vf dsize=672:378
 
 assert PASS in {0, 1, 2}
 
-# An unfair random number generator
-def randint(a, b):
-	return round(float(b - a) * random.random() + float(a))
+# Timestamps are counted in units of 1/ticks seconds (see Config). With 1
+# they are exact Fractions; with 1000000 they are plain integers, which is
+# faster and gives the same result as long as every input time is a whole
+# number of microseconds (and START_TIME is rounded accordingly)
+TIME_BASES = {'fraction': 1, 'microseconds': 1000000}
+
+HTML_CACHE_SIZE = 4096  # Yugi comment texts whose transcoded HTML is kept
+_html_cache = OrderedDict()
 
-def time(s):
-	cs = round(max(s, 0) * 100)
-	s, cs = divmod(cs, 100)
-	m, s = divmod(s, 60)
-	h, m = divmod(m, 60)
-	return '%d:%02d:%02d.%02d' % (h, m, s, cs)
+# An unfair random number generator
+def randint(a, b, rng=random):
+	return round(float(b - a) * rng.random() + float(a))
 
 def color(color):
 	color = (color & 0xff) << 16 | color & 0xff00 | color >> 16
@@ -133,14 +193,12 @@ def escape(text):
 
 class HTMLTranscoder(HTMLParser):
 	def __init__(self):
-		super().__init__(self, convert_charrefs=True)
+		super().__init__(convert_charrefs=True)
 		self.ass = []
+		self.lossy = False
 	def _unsupported(self):
-		if 'html' not in unsupported:
-			print('This file contains HTML that I cannot handle. '
-			      'It will be removed.',
-			      file=sys.stderr)
-			unsupported.add('html')
+		self.lossy = True
+		warn('html')
 	def handle_starttag(self, tag, attrs):
 		nattrs = len(attrs)
 		attrs = dict(attrs)
@@ -210,21 +268,55 @@ class HTMLTranscoder(HTMLParser):
 		self._unsupported()
 
 def transcode_html(text):
+	"""transcode_html(text) -> str
+
+Convert the HTML of a Yugi comment to ASS. The results for the
+HTML_CACHE_SIZE most recently used texts are kept, and the warning about
+unsupported HTML is given again whenever a result that needed it is used."""
+	try:
+		ass, lossy = _html_cache[text]
+	except KeyError:
+		counters['html transcodes'] += 1
+		ass, lossy = _transcode_html(text)
+		_html_cache[text] = ass, lossy
+		if len(_html_cache) > HTML_CACHE_SIZE:
+			_html_cache.popitem(last=False)
+	else:
+		counters['html cache hits'] += 1
+		_html_cache.move_to_end(text)
+	if lossy:
+		warn('html')
+	return ass
+
+def _transcode_html(text):
+	if '<' not in text and '&' not in text:
+		# Plain text, which HTMLParser would pass on as it is.
+		# Escaping cannot put override tags at either end,
+		# so only the spaces there need to be preserved
+		counters['html fast paths'] += 1
+		line = escape(text)
+		if line.startswith(' '):
+			line = r'\h' + line[1:]
+		if line.endswith(' '):
+			line = line[:-1] + r'\h'
+		return line, False
 	lines = text.split('<br>')
 	ass = []
+	lossy = False
 	for line in lines:
 		transcoder = HTMLTranscoder()
 		transcoder.feed(line)
 		transcoder.close()
+		lossy |= transcoder.lossy
 		line = ''.join(transcoder.ass)
 		# Preserve leading and trailing spaces
 		# (let's hope the glyphs are the same!)
-		line = re.sub(r'^((?:\{[^}]*\})*) ', r'\1\h', line)
-		line = re.sub(r' ((?:\{[^}]*\})*)$', r'\h\1', line)
+		line = re.sub(r'^((?:\{[^}]*\})*) ', r'\1\\h', line)
+		line = re.sub(r' ((?:\{[^}]*\})*)$', r'\\h\1', line)
 		ass.append(line)
-	return r'\N'.join(ass)
+	return r'\N'.join(ass), lossy
 
-def tidy_ass(text, font_name):
+def tidy_ass(text, font_name, chars):
 	braces = problematic_braces = False
 	components = []
 	for match in re.finditer(r'(?s)\\\{|(?:\{[^}]*\})+|[^{\\]+|.', text):
@@ -238,11 +330,7 @@ def tidy_ass(text, font_name):
 			braces = True
 		components.append(c)
 	if problematic_braces:
-		if 'braces' not in unsupported:
-			print('This file contains "{" in comments before font changes '
-			      'or before "}". They will appear as "\\" in VSFilter.',
-			      file=sys.stderr)
-			unsupported.add('braces')
+		warn('braces')
 		chars[font_name].add('\\')
 	for i in range(len(components) - 1, -1, -1):
 		if components[i].endswith('}'):
@@ -266,7 +354,40 @@ def parse_args(string):
 		arg = re.sub(r'(?s)\\(.)', r'\1', arg)
 		yield arg
 
+def _side_table(name):
+	"""_side_table(name) -> property
+
+Make an attribute that lives in the instance's _extra dict, which is only
+created for the few chats that set one of these."""
+	def get(self):
+		try:
+			return self._extra[name]
+		except (KeyError, TypeError):
+			raise AttributeError(name) from None
+	def set(self, value):
+		if self._extra is None:
+			self._extra = {}
+		self._extra[name] = value
+	return property(get, set)
+
 class Chat:
+	__slots__ = ('alpha', 'resume', 'hidden', 'text', 'external_type', 'vpos',
+	             'user_id', 'deleted', 'score', 'premium', 'yugi', 'staff',
+	             'sex', 'size', 'valign', 'halign', 'color', 'iyayo', 'se',
+	             'border_color', 'vstart', 'vend', 'command', 'expire',
+	             'priority', 'width', 'height', 'y', 'bounds_key', 'index',
+	             'ustart', 'uend', 'duration', 'distance', 'fwidth', 'xstart',
+	             'xend', '_extra')
+	# Only used by vote commands
+	mode = _side_table('mode')
+	answers = _side_table('answers')
+	results = _side_table('results')
+	result_mode = _side_table('result_mode')
+	vote_vend = _side_table('vote_vend')
+	answer_keys = _side_table('answer_keys')
+	answer_sizes = _side_table('answer_sizes')
+	percentage_keys = _side_table('percentage_keys')
+	percentage_sizes = _side_table('percentage_sizes')
 	_PREMIUM, _YUGI, _STAFF, _SEXINFO, _GENDER = 1, 2, 4, 8, 16
 	_SIZES = {'small': 15, 'normal': 24, 'big': 39}
 	_MAIL = {
@@ -319,29 +440,25 @@ class Chat:
 		'fgreen'        : (0x007800, 'cyalume'),
 		'forange'       : (0xff6600, 'cyalume'),
 	}
-	def __init__(self, text, *,
+	def __init__(self, text, config, *,
 	             external_type=None, thread, vpos=None, date, date_usec='0',
 	             mail=None, user_id, locale=None, no=None, premium='0',
 	             anonymity=None, deleted=None, yourpost=None, score='0'):
+		self._extra = None
 		self.alpha = 1
 		self.resume = False
 		self.hidden = False
 		self.text = text
 		self.external_type = external_type
-		self.thread = thread
-		self.date = int(date) + int(date_usec) * Fraction('0.000001')
+		date = config.seconds(int(date)) + config.seconds(int(date_usec), 1000000)
 		# It's still not clear to me how exactly the date-based thing works,
 		# but I think it has some random error such that trying to floor or
 		# ceil or round or something will not be any more correct than this
-		self.vpos = self.date - START_TIME
+		self.vpos = date - config.seconds(config.start_time)
 		if vpos is not None:
-			self.vpos = max(self.vpos, int(vpos) * Fraction('0.01'))
+			self.vpos = max(self.vpos, config.seconds(int(vpos), 100))
 		self.user_id = user_id
-		self.locale = locale
-		self.no = no
-		self.anonymity = anonymity == '1'
 		self.deleted = deleted == '1'
-		self.yourpost = yourpost == '1'
 		self.score = int(score)
 		premium = int(premium)
 		self.premium = bool(premium & self._PREMIUM)
@@ -380,7 +497,7 @@ class Chat:
 				else:
 					if self.premium or not premium:
 						setattr(self, name, value)
-		assert self.iyayo == self.anonymity, \
+		assert self.iyayo == (anonymity == '1'), \
 			'presence of 184 does not match anonymity'
 		if self.valign != 'normal':
 			self.halign = 'normal'
@@ -394,9 +511,7 @@ class Chat:
 			if not self.resume and (mail is not None and
 			                        ('se1' in mail or 'se2' in mail)):
 				if 'commands' not in unsupported:
-					print('This file contains commands that I cannot handle.',
-					      file=sys.stderr)
-					unsupported.add('commands')
+					warn('commands')
 					unsupported_commands.add('se')
 			if text.startswith('/'):
 				self.command, *args = text[1:].split(' ')
@@ -420,12 +535,7 @@ class Chat:
 						self.result_mode, *self.results = args
 						self.results = list(map(int, self.results))
 						if self.result_mode not in {'percent', 'per'}:
-							if 'result_modes' not in unsupported:
-								print('This file contains voting result modes '
-								      'that I cannot handle. Result mode '
-								      '"per" will be used instead.',
-								      file=sys.stderr)
-								unsupported.add('result_modes')
+							warn('result_modes')
 							self.result_mode = 'per'
 							#text = []
 							#for i, result in enumerate(self.results):
@@ -440,10 +550,7 @@ class Chat:
 					raise NotImplementedError
 				else:
 					if 'commands' not in unsupported:
-						print('This file contains commands '
-						      'that I cannot handle.',
-						      file=sys.stderr)
-						unsupported.add('commands')
+						warn('commands')
 						unsupported_commands.add(self.command)
 					raise NotImplementedError
 			else:
@@ -454,102 +561,110 @@ class Chat:
 					# show
 					pass
 			if self.command in {'perm', 'vote'}:
-				self.vend = self.vstart + self.expire
+				self.vend = self.vstart + config.seconds(self.expire)
 				self.text = transcode_html(self.text)
 		else:
 			self.command = None
 			self.size = self._SIZES[self.size]
-			self.vend = self.vstart + (5 if self.valign == 'normal' else 3)
+			self.vend = self.vstart + config.seconds(5 if self.valign == 'normal' else 3)
 			self.text = escape(self.text)
-	def x(self, vpos):
-		duration = float(self.vend - self.vstart)
-		return WIDTH - (WIDTH + self.width) * float(vpos - self.vstart) / duration
-	def random_y(self):
-		return randint(0, HEIGHT - self.height)
+	def move(self, config):
+		"""C.move(config)
 
-chats = []
-try:
-	tree = ElementTree.parse(args.file)
-	packet = tree.getroot()
-	assert packet.tag == 'packet', 'the root element is not "packet"'
-	for element in packet:
-		assert element.tag == 'chat', \
-			'the root element contains something other than "chat" elements'
-		try:
-			chats.append(Chat(element.text, **element.attrib))
-		except NotImplementedError:
-			pass
-except (AssertionError, ElementTree.ParseError) as e:
-	sys.exit('This is not a valid NicoNico comment XML file: ' + str(e))
-
-chats.sort(key = lambda chat: chat.vstart)
-max_vend = max(chat.vend for chat in chats)
-
-# TODO: priorities
-last = None
-last_vote = None
-for chat in chats:
-	if chat.command == 'vote':
-		if chat.mode == 'showresult':
-			chat.answers = last_vote.answers
-		if last_vote is not None:
-			last_vote.vote_vend = min(last_vote.vote_vend, chat.vstart)
-		if chat.mode == 'stop':
-			if last is not None:
-				last.vend = min(last.vend, chat.vstart)
-				last = None
-			last_vote = None
-		else:
-			chat.vote_vend = max_vend
-			last_vote = chat
-		if not chat.text:
+Precompute the horizontal motion of the chat once its width is known."""
+		# All times are whole microseconds (see START_TIME),
+		# and n / 1e6 rounds exactly like float(Fraction(n, 10**6))
+		scale = 1000000 // config.ticks
+		self.ustart = round(self.vstart * scale)
+		self.uend = round(self.vend * scale)
+		assert self.ustart == self.vstart * scale and \
+		       self.uend == self.vend * scale, \
+			'chat timing is not a whole number of microseconds'
+		self.duration = (self.uend - self.ustart) / 1e6
+		self.distance = float(config.width + self.width)
+		self.fwidth = float(self.width)
+		self.xstart = float(config.width)
+		self.xend = self._ux(self.uend)
+	def _ux(self, upos):
+		return self.xstart - self.distance * ((upos - self.ustart) / 1e6) / self.duration
+	def random_y(self, height, rng=random):
+		return randint(0, height - self.height, rng)
+
+def read_chats(file, config):
+	"""read_chats(file, config) -> iterator of Chat
+
+Parse the comment XML incrementally, yielding a Chat for every supported
+"chat" element. Each element is discarded as soon as its Chat is built,
+so the XML tree never has to fit in memory all at once. Anything after
+the packet is still read, so that junk there raises ParseError."""
+	events = ElementTree.iterparse(file, events=('start', 'end'))
+	yield from _read_packet(events, config)
+	for event in events:
+		pass
+
+def read_stream(file, config, poll=None):
+	"""read_stream(file, config, poll=None) -> iterator of Chat
+
+Parse chats as they arrive on a binary file object: a comment XML file that
+may still be growing, or a stream of "chat" elements, one per line, with or
+without the enclosing "packet". At the end of the file, if poll is a number
+of seconds, wait that long and read on until the packet is closed;
+otherwise, stop. Once the packet is closed, the rest of the file is read
+without waiting, and junk there raises ParseError."""
+	parser = ElementTree.XMLPullParser(events=('start', 'end'))
+	closed = False
+	def events():
+		started = False
+		while True:
+			data = file.readline()
+			if not data:
+				if poll is None or closed:
+					return
+				_import('time').sleep(poll)
+				continue
+			if not started:
+				if not data.strip():
+					continue
+				started = True
+				if not data.lstrip().startswith((b'<?xml', b'<packet')):
+					parser.feed(b'<packet>')
+			parser.feed(data)
+			yield from parser.read_events()
+	packet = events()
+	yield from _read_packet(packet, config)
+	closed = True
+	for event in packet:
+		pass
+
+def _read_packet(events, config):
+	depth = 0
+	packet = None
+	for event, element in events:
+		if event == 'start':
+			if not depth:
+				assert element.tag == 'packet', \
+					'the root element is not "packet"'
+				packet = element
+			elif depth == 1:
+				assert element.tag == 'chat', \
+					'the root element contains something other than "chat" elements'
+			depth += 1
 			continue
-	if chat.command in {'perm', 'vote'}:
-		if last is not None:
-			last.vend = min(last.vend, chat.vstart)
-		if not chat.expire:
-			chat.vend = max_vend
-		last = chat
-	elif chat.command in {'clear', 'cls'}:
-		if last is not None:
-			last.vend = min(last.vend, chat.vstart)
-			last = None
-
-if PASS <= 1:
-	for chat in chats:
-		if chat.command == 'vote' and chat.mode == 'stop':
+		depth -= 1
+		if not depth:
+			break
+		if depth != 1:
 			continue
-		if chat.command in {None, 'perm', 'vote'}:
-			chat.width, chat.height = Fraction('39'), Fraction('26.875')
-		if chat.command == 'vote' and chat.mode != 'stop':
-			chat.answer_sizes = [(Fraction('39'), Fraction('36'))
-			                     for answer in chat.answers]
-			if chat.mode == 'showresult':
-				chat.percentage_sizes = chat.answer_sizes
-else:
-	with open('bounds.txt') as bounds:
-		for chat in chats:
-			if chat.command == 'vote' and chat.mode == 'stop':
-				continue
-			if chat.command == 'perm' or chat.command == 'vote' and chat.text:
-				bounds.readline()
-				bounds.readline()
-			if (chat.command in {None, 'perm'} or
-			    chat.command == 'vote' and chat.text):
-				chat.width, chat.height = map(Fraction,
-				                              bounds.readline().split()[1:])
-			if chat.command == 'vote' and chat.mode != 'stop':
-				chat.answer_sizes = []
-				if chat.mode == 'showresult':
-					chat.percentage_sizes = []
-				for answer in chat.answers:
-					bounds.readline()
-					bounds.readline()
-					chat.answer_sizes.append(tuple(map(Fraction,
-						bounds.readline().split()[1:])))
-					if chat.mode == 'showresult':
-						chat.percentage_sizes.append(tuple(map(Fraction,
-							bounds.readline().split()[1:])))
+		try:
+			chat = Chat(element.text, config, **element.attrib)
+		except NotImplementedError:
+			counters['chats skipped'] += 1
+			chat = None
+		# Drop the consumed element (and anything else the packet holds)
+		packet.clear()
+		if chat is not None:
+			counters['chats parsed'] += 1
+			yield chat
 
 Point = namedtuple('Point', ('x', 'y'))
 
@@ -585,15 +700,15 @@ class Rectangle:
 		return Point(self._left + self._width / 2,
 		             self._top + self._height / 2)
 
-def answer_box(i, n):
+def answer_box(i, n, layout_width, layout_height):
 	assert 2 <= n <= 9, 'invalid number of answers in a vote command'
 	spacing = 6
 	columns = 3 - (n in {2, 4})
 	rows = 3 - (n < 7)
 	x_offset = (columns - n % columns) / 2 * (i >= n - n % columns)
 	y_offset = 0.5 * (n < 4)
-	width = Fraction(WIDTH - spacing * (columns + 1), columns)
-	height = Fraction(HEIGHT - spacing * (rows + 1), rows)
+	width = Fraction(layout_width - spacing * (columns + 1), columns)
+	height = Fraction(layout_height - spacing * (rows + 1), rows)
 	x = i % columns + x_offset
 	y = i // columns + y_offset
 	x = spacing * (x + 1) + width * x
@@ -606,15 +721,37 @@ def answer_box(i, n):
 #	log2 = lambda x: math.log(x, 2)
 
 class Drawing:
-	__slots__ = '_commands', '_p'
+	# The points of all contours are kept in flat parallel lists:
+	# _modes has the mode (drawing command) of each point, _xs and _ys
+	# its coordinates, and _starts the index of the first point of each
+	# contour. _fixed has the coordinates in fixed point (see _fix()).
+	__slots__ = '_modes', '_xs', '_ys', '_starts', '_fixed', '_p'
+	# Precisions go up to 31 (30 fractional bits), so two more bits
+	# are enough to round coordinates correctly at any of them
+	FIXED_BITS = 32
 	@classmethod
-	def _from_commands(cls, commands):
+	def _from_points(cls, modes, xs, ys, starts):
 		obj = super().__new__(cls)
-		obj._commands = commands
+		# Drop a final line back to where the contour starts
+		new_starts = []
+		dropped = set()
+		for start, end in zip(starts, starts[1:] + [len(modes)]):
+			new_starts.append(start - len(dropped))
+			last = end - 1
+			if (modes[last] == 'l' and xs[last] == xs[start] and
+			    ys[last] == ys[start]):
+				dropped.add(last)
+		if dropped:
+			kept = [i for i in range(len(modes)) if i not in dropped]
+			modes = [modes[i] for i in kept]
+			xs = [xs[i] for i in kept]
+			ys = [ys[i] for i in kept]
+		obj._modes = modes
+		obj._xs = xs
+		obj._ys = ys
+		obj._starts = new_starts
+		obj._fixed = None
 		obj._p = None
-		for contour in commands:
-			if contour[-1] == ('l', contour[0][1], contour[0][2]):
-				contour.pop()
 		return obj
 	def __new__(cls, words):
 		if isinstance(words, str):
@@ -624,8 +761,11 @@ class Drawing:
 					words[i] = Fraction(Decimal(words[i]))
 				except Exception:
 					pass
-		commands = []
-		contour = []
+		modes = []
+		xs = []
+		ys = []
+		starts = []
+		start = 0
 		mode = None
 		arg = None
 		had_commands = True
@@ -638,7 +778,9 @@ class Drawing:
 				else:
 					if mode == 'm' and had_commands:
 						raise ValueError('empty contour in drawing')
-					contour.append((mode, arg, word))
+					modes.append(mode)
+					xs.append(arg)
+					ys.append(word)
 					arg = None
 					had_commands = True
 			elif isinstance(word, str):
@@ -650,109 +792,132 @@ class Drawing:
 					raise ValueError('not enough numbers in drawing')
 				if mode == 'm' == word:
 					raise ValueError('empty contour in drawing')
-				if word == 'm' and contour:
-					commands.append(contour)
-					contour = []
+				if word == 'm' and len(modes) > start:
+					starts.append(start)
+					start = len(modes)
 				mode = word
 				had_commands = False
 			else:
 				raise TypeError('drawing elements must be real numbers or '
 				                "strings, not '%s'" % type(word).__name__)
-		if not commands:
+		if not starts:
 			raise ValueError('empty drawing')
-		return cls._from_commands(commands)
+		return cls._from_points(modes, xs, ys, starts)
 	@staticmethod
-	def _p_upper_bound(number):
-		#number = abs(number)
-		#return min(math.ceil(log2((1 << Drawing.MAX_P) / number)),
-		#           Drawing.MAX_P)
-		shift = 0
-		while shift < 31:
-			if not -1 << 25 <= round(number * (1 << shift)) < 1 << 25:
-				break
+	def _fix(number):
+		# (floor(number * 2**FIXED_BITS), whether that is exact),
+		# from which _round() can find number rounded at any precision
+		# without further (for TransformedSqrt2, slow) exact arithmetic
+		if isinstance(number, Decimal):
+			number = Fraction(number)
+		scaled = number * (1 << Drawing.FIXED_BITS)
+		floor = math.floor(scaled)
+		return floor, scaled == floor
+	@staticmethod
+	def _round(fixed, shift):
+		# round(number * (1 << shift)), rounding half to even,
+		# given fixed = Drawing._fix(number)
+		floor, exact = fixed
+		drop = Drawing.FIXED_BITS - shift
+		half = 1 << drop - 1
+		x = floor + half >> drop
+		if x & 1 and exact and (floor & (half << 1) - 1) == half:
+			x -= 1
+		return x
+	@staticmethod
+	def _p_upper_bound(fixed):
+		# The first shift at which the number no longer fits in 26 bits.
+		# Guess it from the number's bit length, and then correct the guess
+		# (which is off by one at most) by checking the shifts around it.
+		def fits(shift):
+			return -1 << 25 <= Drawing._round(fixed, shift) < 1 << 25
+		shift = 25 + Drawing.FIXED_BITS - fixed[0].bit_length()
+		shift = min(max(shift, 0), 31)
+		while shift and not fits(shift - 1):
+			shift -= 1
+		while shift < 31 and fits(shift):
 			shift += 1
 		if not shift:
 			raise ValueError('coordinate too large in drawing')
 		return shift
 	@staticmethod
-	def _p_lower_bound(number, p):
-		#number = abs(number)
-		#shift = 0
-		#while shift < Drawing.MAX_P:
-		#	x = number * (1 << shift)
-		#	shift += 1
-		#	if int(x) == x:
-		#		break
-		#return shift
-		x = round(number * (1 << p - 1))
+	def _p_lower_bound(fixed, p):
+		x = Drawing._round(fixed, p - 1)
 		if not x:
 			return 1
-		while not x & 1:
-			x >>= 1
-			p -= 1
-		return p
+		# Drop the trailing zero bits
+		return p + 1 - (x & -x).bit_length()
+	def _fixed_coordinates(self):
+		if self._fixed is None:
+			self._fixed = list(map(self._fix, itertools.chain(self._xs,
+			                                                  self._ys)))
+		return self._fixed
 	@property
 	def p(self):
 		if self._p is not None:
 			return self._p
-		p = min(min(self._p_upper_bound(x),
-		            self._p_upper_bound(y)) for contour in self._commands
-		                                    for m, x, y in contour)
-		p = max(max(self._p_lower_bound(x, p),
-		            self._p_lower_bound(y, p)) for contour in self._commands
-		                                       for m, x, y in contour)
+		fixed = self._fixed_coordinates()
+		p = min(map(self._p_upper_bound, fixed))
+		p = max(self._p_lower_bound(coordinate, p) for coordinate in fixed)
 		self._p = p
 		return p
 	def __str__(self):
 		words = []
 		mode = None
 		shift = self.p - 1
-		for contour in self._commands:
-			for m, x, y in contour:
-				if m != mode:
-					words.append(m)
-					mode = m
-				words.append(str(round(x * (1 << shift))))
-				words.append(str(round(y * (1 << shift))))
+		fixed = self._fixed_coordinates()
+		count = len(self._modes)
+		for m, x, y in zip(self._modes, fixed[:count], fixed[count:]):
+			if m != mode:
+				words.append(m)
+				mode = m
+			words.append(str(self._round(x, shift)))
+			words.append(str(self._round(y, shift)))
 		return ' '.join(words)
 	def __repr__(self):
 		words = []
 		mode = None
-		for contour in self._commands:
-			for m, x, y in contour:
-				if m != mode:
-					words.append(m)
-					mode = m
-				words.append(x)
-				words.append(y)
+		for m, x, y in zip(self._modes, self._xs, self._ys):
+			if m != mode:
+				words.append(m)
+				mode = m
+			words.append(x)
+			words.append(y)
 		return 'Drawing(%r)' % words
 	def __reversed__(self):
-		commands = []
-		for contour in self._commands:
-			mode = 'm'
-			reversed_contour = []
-			for m, x, y in contour[::-1]:
-				reversed_contour.append((mode, x, y))
-				mode = m
-			commands.append(reversed_contour)
-		return self._from_commands(commands)
+		modes = []
+		xs = []
+		ys = []
+		starts = []
+		for start, end in zip(self._starts,
+		                      self._starts[1:] + [len(self._modes)]):
+			starts.append(len(modes))
+			# Each point is reached with the mode of the point after it
+			modes.append('m')
+			modes.extend(self._modes[end - 1:start:-1])
+			xs.extend(reversed(self._xs[start:end]))
+			ys.extend(reversed(self._ys[start:end]))
+		return self._from_points(modes, xs, ys, starts)
 	def __add__(self, vector):
 		if not isinstance(vector, tuple):
 			raise NotImplemented
 		dx, dy = vector
-		commands = [[(m, x + dx, y + dy) for m, x, y in contour]
-		                                 for contour in self._commands]
-		return self._from_commands(commands)
+		return self._from_points(self._modes, [x + dx for x in self._xs],
+		                         [y + dy for y in self._ys], self._starts)
 	def __mul__(self, other):
 		if not isinstance(other, (numbers.Real, Decimal)):
 			return NotImplemented
-		commands = [[(m, x * other, y * other) for m, x, y in contour]
-		                                       for contour in self._commands]
-		return self._from_commands(commands)
+		return self._from_points(self._modes, [x * other for x in self._xs],
+		                         [y * other for y in self._ys], self._starts)
 	def __xor__(self, other):
 		if not isinstance(other, Drawing):
 			return NotImplemented
-		return self._from_commands(self._commands + reversed(other)._commands)
+		other = reversed(other)
+		count = len(self._modes)
+		return self._from_points(self._modes + other._modes,
+		                         self._xs + other._xs, self._ys + other._ys,
+		                         self._starts + [start + count
+		                                         for start in other._starts])
 
 _PyHASH_MODULUS = sys.hash_info.modulus
 
@@ -764,8 +929,28 @@ if _PyHASH_MODULUS & 7 == 7:
 else:
 	_PyHASH_SQRT2 = None
 
+try:
+	isqrt = math.isqrt
+except AttributeError:
+	def isqrt(n):
+		"""isqrt(n) -> int
+
+Return the integer square root of the nonnegative integer n."""
+		if not n:
+			return 0
+		x = 1 << (n.bit_length() + 1 >> 1)
+		while True:
+			y = x + n // x >> 1
+			if y >= x:
+				return x
+			x = y
+
 class TransformedSqrt2(numbers.Real):
-	__slots__ = 'coef', 'offset'
+	# Instances are immutable, so _bracket, _floats and _rounded cache
+	# what _get_bracket(), _float_bounds() and _newton() find
+	__slots__ = 'coef', 'offset', '_bracket', '_floats', '_rounded'
+	# Fractional bits of sqrt(2) * coef found by _get_bracket()
+	BRACKET_BITS = 64
 	def __new__(cls, coef, offset):
 		if not isinstance(coef, numbers.Rational):
 			raise TypeError("coef must be a rational number")
@@ -774,6 +959,9 @@ class TransformedSqrt2(numbers.Real):
 		obj = super().__new__(cls)
 		obj.coef = Fraction(coef)
 		obj.offset = Fraction(offset)
+		obj._bracket = None
+		obj._floats = None
+		obj._rounded = None
 		return obj
 	def __abs__(self):
 		return -self if self < 0 else +self
@@ -867,21 +1055,63 @@ class TransformedSqrt2(numbers.Real):
 		return NotImplemented
 	def __neg__(self):
 		return TransformedSqrt2(-self.coef, -self.offset)
+	def _get_bracket(self):
+		# (lo, den) such that lo / den < X < (lo + 1) / den,
+		# for nonzero X.coef, found using integer square roots
+		if self._bracket is None:
+			p, q = self.coef.numerator, self.coef.denominator
+			r, s = self.offset.numerator, self.offset.denominator
+			bits = self.BRACKET_BITS
+			root = isqrt(2 * (p * s) ** 2 << 2 * bits)
+			if p < 0:
+				root = -root - 1
+			self._bracket = root + (r * q << bits), q * s << bits
+		return self._bracket
+	def _float_bounds(self):
+		# The correctly rounded floats of some lo <= X and hi >= X,
+		# or None if they overflow. Rounding is monotonic, so if one
+		# number's hi float is below another's lo float, so is the number.
+		if self._floats is None:
+			try:
+				if not self.coef:
+					lo = hi = float(self.offset)
+				else:
+					lo, den = self._get_bracket()
+					lo, hi = lo / den, (lo + 1) / den
+			except OverflowError:
+				self._floats = ()
+			else:
+				self._floats = lo, hi
+		return self._floats or None
 	def _newton(self, round):
 		"""X._newton(round)
 
-Find round(X.coef * sqrt(2) + X.offset) using the Newton-Raphson method."""
+Find round(X.coef * sqrt(2) + X.offset) using the Newton-Raphson method.
+round must be monotonic. The result is remembered for each round, and
+the Newton-Raphson method is only used if the ends of X._get_bracket()
+round differently."""
+		if self._rounded is None:
+			self._rounded = {}
+		elif round in self._rounded:
+			return self._rounded[round]
 		a, b = self.coef, self.offset
 		if not a:
-			return round(b)
-		l, r = a, 2 * a
-		aa2 = r * a
-		while True:
-			rl = round(l + b)
-			if rl == round(r + b):
-				return rl
-			r = (l + r) / 2
-			l = aa2 / r
+			result = round(b)
+		else:
+			lo, den = self._get_bracket()
+			result = round(Fraction(lo, den))
+			if result != round(Fraction(lo + 1, den)):
+				l, r = a, 2 * a
+				aa2 = r * a
+				while True:
+					rl = round(l + b)
+					if rl == round(r + b):
+						break
+					r = (l + r) / 2
+					l = aa2 / r
+				result = rl
+		self._rounded[round] = result
+		return result
 	def __pos__(self):
 		return TransformedSqrt2(self.coef, self.offset)
 	def __pow__(self, other):
@@ -932,6 +1162,26 @@ Find round(X.coef * sqrt(2) + X.offset) using the Newton-Raphson method."""
 			return complex(other) // complex(self)
 		return NotImplemented
 	def _richcmp(self, other, op):
+		# Usually, floats are enough to tell which number is greater
+		bounds = self._float_bounds()
+		if bounds is not None:
+			if isinstance(other, TransformedSqrt2):
+				other_bounds = other._float_bounds()
+			elif isinstance(other, (numbers.Rational, float, Decimal)):
+				try:
+					other_bounds = (float(other),) * 2
+				except (OverflowError, ValueError):
+					other_bounds = None
+				else:
+					if not math.isfinite(other_bounds[0]):
+						other_bounds = None
+			else:
+				other_bounds = None
+			if other_bounds is not None:
+				if bounds[1] < other_bounds[0]:
+					return op(0, 1)
+				if bounds[0] > other_bounds[1]:
+					return op(1, 0)
 		# (a - c) * sqrt(2) op d - b
 		# where a, b, c, d = self.coef, self.offset, other.coef, other.offset
 		if isinstance(other, TransformedSqrt2):
@@ -1024,6 +1274,46 @@ Find round(X.coef * sqrt(2) + X.offset) using the Newton-Raphson method."""
 	def __trunc__(self):
 		return self._newton(math.trunc)
 
+AnswerGeometry = namedtuple('AnswerGeometry', ('box', 'center', 'middle_p',
+                                               'middle', 'outline_p',
+                                               'outline'))
+
+# AnswerGeometry by (i, n, layout width, layout height, scale, offset)
+_answer_geometry = {}
+
+def answer_geometry(i, n, config):
+	"""answer_geometry(i, n, config) -> AnswerGeometry
+
+Return the box of the i-th of n vote answers (see answer_box()) along with
+what the script shows of it at the PlayRes of config: G.center is
+the position of its center, and G.middle and G.outline are the drawings
+of its fill and its border, to be drawn at the \\p levels G.middle_p and
+G.outline_p. The exact arithmetic is only done once for each box."""
+	key = i, n, config.width, config.height, config.scale, config.offset
+	try:
+		return _answer_geometry[key]
+	except KeyError:
+		pass
+	box = answer_box(i, n, config.width, config.height)
+	thickness = max(box.width * Fraction('0.015'), 2)
+	radius = box.width * Fraction('0.15') / 2
+	outer = rounded_box(box.width, box.height,
+	                    radius + thickness / 2)
+	middle = rounded_box(box.width - thickness,
+	                     box.height - thickness,
+	                     radius)
+	inner = rounded_box(box.width - thickness * 2,
+	                    box.height - thickness * 2,
+	                    radius - thickness / 2)
+	outline = outer ^ (inner + (thickness, thickness))
+	middle *= config.scale
+	outline *= config.scale
+	geometry = AnswerGeometry(box, '%s,%s' % (config.x(box.center.x),
+	                                          config.y(box.center.y)),
+	                          middle.p, str(middle), outline.p, str(outline))
+	_answer_geometry[key] = geometry
+	return geometry
+
 def rounded_box(width, height, radius):
 	w = width
 	h = height
@@ -1037,71 +1327,1380 @@ def rounded_box(width, height, radius):
 	                'l',   0 ,  r ,  'b',   0 ,   o ,   o ,  0 ,   r ,  0 ))
 
 class SegmentTree:
-	__slots__ = '_vstart', '_vend', '_chats', '_leaf', '_left', '_right'
-	def __init__(self, vstart, vend):
+	"""SegmentTree(vstart, vend, resolution=1)
+
+Index of chats by the time they are on screen. [vstart, vend) is cut
+into buckets of 1/resolution seconds, which are the leaves of a binary
+tree stored implicitly in a flat list: node i has children 2*i and 2*i+1,
+and the leaves start at index size. Nodes hold lists of chats and are
+only allocated once something is added to them."""
+	__slots__ = '_vstart', '_resolution', '_size', '_chats'
+	def __init__(self, vstart, vend, resolution=1):
 		self._vstart = vstart
-		self._vend = vend
-		self._chats = set()
-		self._leaf = vend - vstart == 1
-		if not self._leaf:
-			vmiddle = vstart + vend >> 1
-			self._left = SegmentTree(vstart, vmiddle)
-			self._right = SegmentTree(vmiddle, vend)
+		self._resolution = resolution
+		buckets = max(math.ceil((vend - vstart) * resolution), 1)
+		self._size = 1 << (buckets - 1).bit_length()
+		self._chats = [None] * (2 * self._size)
+	def _buckets(self, vstart, vend):
+		# floor and ceil without making a Fraction out of integer times
+		numerator = self._resolution.numerator
+		denominator = self._resolution.denominator
+		first = (vstart - self._vstart) * numerator // denominator
+		last = -((self._vstart - vend) * numerator // denominator)
+		return max(first, 0), min(last, self._size)
 	def add(self, chat):
-		if chat.vstart >= self._vend or chat.vend <= self._vstart:
-			return
-		elif (self._leaf or
-		      chat.vstart <= self._vstart and chat.vend >= self._vend):
-			self._chats.add(chat)
+		first, last = self._buckets(chat.vstart, chat.vend)
+		first += self._size
+		last += self._size
+		chats = self._chats
+		while first < last:
+			if first & 1:
+				if chats[first] is None:
+					chats[first] = []
+				chats[first].append(chat)
+				first += 1
+			if last & 1:
+				last -= 1
+				if chats[last] is None:
+					chats[last] = []
+				chats[last].append(chat)
+			first >>= 1
+			last >>= 1
+	def query(self, vstart, vend):
+		"""T.query(vstart, vend) -> set
+
+Return the chats that were added to any bucket overlapping [vstart, vend).
+This includes every added chat that is on screen during that time."""
+		counters['tree queries'] += 1
+		result = set()
+		first, last = self._buckets(vstart, vend)
+		if first >= last:
+			return result
+		first += self._size
+		last += self._size - 1
+		chats = self._chats
+		# Every node on the path from these leaves to the root
+		while first:
+			for node in chats[first:last + 1]:
+				if node is not None:
+					result.update(node)
+			first >>= 1
+			last >>= 1
+		return result
+
+class Layout:
+	"""Layout(vstart, vend, config)
+
+Collision layout for danmaku shown between vstart and vend. Chats must be
+placed in order of vstart; each is moved off every previously placed chat
+of the same kind (scrolling or fixed) that it would collide with.
+
+The motion of every placed chat is also kept in flat columns,
+which the NumPy collision test indexes by chat.index."""
+	__slots__ = ('_config', '_tree', '_ustart', '_uend', '_duration',
+	             '_distance', '_fwidth')
+	def __init__(self, vstart, vend, config):
+		self._config = config
+		self._tree = SegmentTree(vstart, vend,
+		                         Fraction(LAYOUT_RESOLUTION, config.ticks))
+		self._ustart = array.array('q')
+		self._uend = array.array('q')
+		self._duration = array.array('d')
+		self._distance = array.array('d')
+		self._fwidth = array.array('d')
+	@staticmethod
+	def _collides(chat, previous_chat):
+		if chat.ustart >= previous_chat.ustart:
+			ustart = chat.ustart
+			xstart = chat.xstart
+			previous_xstart = previous_chat._ux(ustart)
+		else:
+			ustart = previous_chat.ustart
+			xstart = chat._ux(ustart)
+			previous_xstart = previous_chat.xstart
+		if chat.uend <= previous_chat.uend:
+			uend = chat.uend
+			xend = chat.xend
+			previous_xend = previous_chat._ux(uend)
+		else:
+			uend = previous_chat.uend
+			xend = chat._ux(uend)
+			previous_xend = previous_chat.xend
+		if ustart >= uend:
+			return False
+		return ((xstart + chat.fwidth > previous_xstart and
+		         previous_xstart + previous_chat.fwidth > xstart) or
+		        (xend + chat.fwidth > previous_xend and
+		         previous_xend + previous_chat.fwidth > xend))
+	def _collisions(self, chat, previous_chats):
+		# Same as _collides, for all previous chats at once
+		indices = numpy.fromiter((previous_chat.index
+		                          for previous_chat in previous_chats),
+		                         numpy.intp, len(previous_chats))
+		def column(values, dtype):
+			return numpy.frombuffer(values, dtype)[indices]
+		previous_ustart = column(self._ustart, numpy.int64)
+		previous_uend = column(self._uend, numpy.int64)
+		previous_duration = column(self._duration, numpy.float64)
+		previous_distance = column(self._distance, numpy.float64)
+		previous_width = column(self._fwidth, numpy.float64)
+		ustart = numpy.maximum(previous_ustart, chat.ustart)
+		uend = numpy.minimum(previous_uend, chat.uend)
+		width = self._config.width
+		def x(upos):
+			return width - chat.distance * ((upos - chat.ustart) / 1e6) / chat.duration
+		def previous_x(upos):
+			return width - previous_distance * ((upos - previous_ustart) / 1e6) / previous_duration
+		xstart, xend = x(ustart), x(uend)
+		previous_xstart, previous_xend = previous_x(ustart), previous_x(uend)
+		return ((ustart < uend) &
+		        (((xstart + chat.fwidth > previous_xstart) &
+		          (previous_xstart + previous_width > xstart)) |
+		         ((xend + chat.fwidth > previous_xend) &
+		          (previous_xend + previous_width > xend))))
+	def place(self, chat, rng=random):
+		"""L.place(chat, rng=random) -> bool
+
+Move chat.y to the first free slot at or below (above, for bottom chats)
+its current position. If there is none, make the chat translucent, put it
+at a random height drawn from rng and return True."""
+		chat.move(self._config)
+		scrolling = chat.valign == 'normal'
+		previous_chats = [previous_chat for previous_chat
+		                  in self._candidates(chat)
+		                  if (previous_chat.valign == 'normal') == scrolling]
+		counters['candidate pairs'] += len(previous_chats)
+		# Whether two chats collide doesn't depend on their heights,
+		# so find the obstacles first, then sweep through them
+		# in order of y, jumping past each one that overlaps
+		if (len(previous_chats) >= NUMPY_MIN_CHATS and
+		    _import_numpy() is not None):
+			obstacles = list(itertools.compress(
+				previous_chats, self._collisions(chat, previous_chats)))
+		else:
+			obstacles = [previous_chat for previous_chat in previous_chats
+			             if self._collides(chat, previous_chat)]
+		height = self._config.height
+		overflow = False
+		if chat.valign == 'bottom':
+			obstacles.sort(key=lambda previous_chat:
+				(-previous_chat.y - previous_chat.height, -previous_chat.y))
+			for previous_chat in obstacles:
+				if previous_chat.y + previous_chat.height <= chat.y:
+					break
+				if previous_chat.y >= chat.y + chat.height:
+					continue
+				counters['sweep jumps'] += 1
+				chat.y = previous_chat.y - chat.height - 1
+				if chat.y + chat.height > height:
+					overflow = True
+					break
 		else:
-			self._left.add(chat)
-			self._right.add(chat)
-	def __getitem__(self, vpos):
-		if not self._vstart <= vpos < self._vend:
-			return frozenset()
-		if self._leaf:
-			return frozenset(self._chats)
-		return self._left[vpos] | self._right[vpos] | self._chats
+			obstacles.sort(key=lambda previous_chat:
+				(previous_chat.y, previous_chat.y + previous_chat.height))
+			for previous_chat in obstacles:
+				if previous_chat.y >= chat.y + chat.height:
+					break
+				if previous_chat.y + previous_chat.height <= chat.y:
+					continue
+				counters['sweep jumps'] += 1
+				chat.y = previous_chat.y + previous_chat.height + 1
+				if chat.y + chat.height > height:
+					overflow = True
+					break
+		if overflow:
+			counters['overflows'] += 1
+			chat.alpha = DANMAKU_ALPHA
+			chat.y = chat.random_y(height, rng)
+		self._add(chat)
+		return overflow
+	def _candidates(self, chat):
+		return self._tree.query(chat.vstart, chat.vend)
+	def _add(self, chat):
+		self._append(chat)
+		self._tree.add(chat)
+	def _append(self, chat):
+		chat.index = len(self._ustart)
+		self._ustart.append(chat.ustart)
+		self._uend.append(chat.uend)
+		self._duration.append(chat.duration)
+		self._distance.append(chat.distance)
+		self._fwidth.append(chat.fwidth)
+
+class ActiveLayout(Layout):
+	"""ActiveLayout(config)
+
+Layout for a stream of chats whose length is not known in advance.
+Instead of indexing every chat by time, it only keeps those that are
+still on screen when the latest chat appears."""
+	__slots__ = '_active',
+	def __init__(self, config):
+		self._config = config
+		self._tree = None
+		self._active = []
+		self._ustart = array.array('q')
+		self._uend = array.array('q')
+		self._duration = array.array('d')
+		self._distance = array.array('d')
+		self._fwidth = array.array('d')
+	def _candidates(self, chat):
+		# Chats come in order of vstart, so nothing that is gone by now
+		# can collide with this chat or any later one
+		active = [previous_chat for previous_chat in self._active
+		          if previous_chat.uend > chat.ustart]
+		if len(active) < len(self._active):
+			self._active = []
+			for column in (self._ustart, self._uend, self._duration,
+			               self._distance, self._fwidth):
+				del column[:]
+			for previous_chat in active:
+				self._add(previous_chat)
+		return self._active
+	def _add(self, chat):
+		self._append(chat)
+		self._active.append(chat)
 
 # Niconico player (Flash) metrics (based on GDI in some way)
 LINE_HEIGHT = {15: 22, 24: 33, 39: 49}
 ASCENDER = {15: 16, 24: 25, 39: 38}
 
-# VSFilter metrics (GDI with fs*=64 and then lround(asc,desc/=8))
-FONTS = OrderedDict((
-	('Arial', ('a', freetype.Face('ARIALBD.TTF'),
-	           {24: {'fs': 27, 'asc': Fraction(175, 8), 'desc': Fraction(41, 8)},
-	            15: {'fs': 17, 'asc': Fraction(110, 8), 'desc': Fraction(26, 8)},
-	            39: {'fs': 44, 'asc': Fraction(285, 8), 'desc': Fraction(67, 8)}})),
-	('MS PGothic', ('g', freetype.Face('/Library/Fonts/Microsoft/MS PGothic.ttf'),
-	                {24: {'fs': 24, 'asc': Fraction(165, 8), 'desc': Fraction(27, 8)},
-	                 15: {'fs': 15, 'asc': Fraction(103, 8), 'desc': Fraction(17, 8)},
-	                 39: {'fs': 39, 'asc': Fraction(268, 8), 'desc': Fraction(44, 8)}})),
-	('Segoe UI Symbol', (None, freetype.Face('SEGUISYM.TTF'),
-	                     {24: {'fs': 32, 'asc': Fraction(208, 8), 'desc': Fraction(48, 8)}})),
-	('Nirmala UI', (None, freetype.Face('NIRMALAB.TTF'),
-	                {24: {'fs': 32, 'asc': Fraction(208, 8), 'desc': Fraction(49, 8)}})),
+FONT_FILES = OrderedDict((
+	('Arial', 'ARIALBD.TTF'),
+	('MS PGothic', '/Library/Fonts/Microsoft/MS PGothic.ttf'),
+	('Segoe UI Symbol', 'SEGUISYM.TTF'),
+	('Nirmala UI', 'NIRMALAB.TTF'),
 ))
 
+class LazyFace:
+	"""LazyFace(path)
+
+A freetype.Face for the font file at path that is only opened
+(and freetype only imported) when it is first used."""
+	__slots__ = '_path', '_face'
+	def __init__(self, path):
+		self._path = path
+		self._face = None
+	def __getattr__(self, name):
+		if self._face is None:
+			freetype = _import('freetype')
+			start = timeit.default_timer()
+			self._face = freetype.Face(self._path)
+			startup_times['opening ' + self._path] = timeit.default_timer() - start
+		return getattr(self._face, name)
+
+# VSFilter metrics (GDI with fs*=64 and then lround(asc,desc/=8))
+def load_fonts(font_files=FONT_FILES):
+	return OrderedDict((
+		('Arial', ('a', LazyFace(font_files['Arial']),
+		           {24: {'fs': 27, 'asc': Fraction(175, 8), 'desc': Fraction(41, 8)},
+		            15: {'fs': 17, 'asc': Fraction(110, 8), 'desc': Fraction(26, 8)},
+		            39: {'fs': 44, 'asc': Fraction(285, 8), 'desc': Fraction(67, 8)}})),
+		('MS PGothic', ('g', LazyFace(font_files['MS PGothic']),
+		                {24: {'fs': 24, 'asc': Fraction(165, 8), 'desc': Fraction(27, 8)},
+		                 15: {'fs': 15, 'asc': Fraction(103, 8), 'desc': Fraction(17, 8)},
+		                 39: {'fs': 39, 'asc': Fraction(268, 8), 'desc': Fraction(44, 8)}})),
+		('Segoe UI Symbol', (None, LazyFace(font_files['Segoe UI Symbol']),
+		                     {24: {'fs': 32, 'asc': Fraction(208, 8), 'desc': Fraction(48, 8)}})),
+		('Nirmala UI', (None, LazyFace(font_files['Nirmala UI']),
+		                {24: {'fs': 32, 'asc': Fraction(208, 8), 'desc': Fraction(49, 8)}})),
+	))
+
+# The fonts of the current conversion (see use_fonts())
+FONTS = None
+# (fonts, glyph metrics, font runs) for every set of font files
+# opened in this process
+_font_sets = {}
+
 SIZE = 24
 COLOR = 0xffffff
 BORDER_ALPHA = Fraction(8, 15)
 BORDER_COLOR = 0x000000
 WIDTH = 672
 HEIGHT = 378
+SCALE = 13  # PlayRes pixels per layout pixel
 DANMAKU_ALPHA = Fraction('0.6')
+LAYOUT_RESOLUTION = 4  # collision candidates are looked up in 1/4 s buckets
+FONT_RUNS_CACHE_SIZE = 65536  # danmaku texts whose font runs are kept
+SHARD_SECONDS = 600  # length of the pieces of the timeline laid out in parallel
+SHARD_MARGIN = 30  # how early each piece starts to settle its layout
+NUMPY_MIN_CHATS = 48  # test at least this many candidates at once with NumPy
+INDEX_STEP = 10  # seconds between the seek points in a SortedSink's index
 QUESTION_HORIZONTAL_PADDING = 6
 QUESTION_MIN_SIZE = 24
 QUESTION_MAX_SIZE = 36
-QUESTION_SIZE = QUESTION_MAX_SIZE if PASS <= 1 else QUESTION_MIN_SIZE * Fraction(2, 3)
 YUGI_HEIGHT = 56
-YUGI_SCALE = 100 if PASS <= 1 else 99
+YUGI_OUTLINE = Fraction(14, 13)  # of the box behind operator comments
+
+class Config:
+	"""Config(start_time=START_TIME, pass_number=PASS, width=WIDTH, height=HEIGHT, time_base='fraction', font_files=FONT_FILES, seed=None, scale=SCALE, aspect=None, max_danmaku=None)
+
+Settings for converting comments. start_time is when the video stream
+starts, as a POSIX timestamp; pass_number is the PASS to run; width and
+height are the layout resolution; time_base is a key of TIME_BASES;
+font_files maps the names of the fonts in load_fonts() to their files;
+seed, unless it is None, makes the random heights of danmaku that do
+not fit reproducible (see chat_random()); and max_danmaku, unless it is
+None, limits how many danmaku are shown at a time (see decimate()).
+
+scale and aspect only affect rendering: the script's PlayRes is scale
+times the layout resolution, widened or heightened to the aspect ratio
+aspect (width / height) unless it is None, with the layout centered
+in it. C.play_res is that PlayRes and C.offset is where the layout's
+top left corner goes, in layout pixels."""
+	__slots__ = ('start_time', 'pass_number', 'width', 'height', 'time_base',
+	             'font_files', 'seed', 'scale', 'aspect', 'max_danmaku',
+	             'ticks', 'play_res', 'offset')
+	_SETTINGS = __slots__[:-3]
+	def __init__(self, start_time=START_TIME, pass_number=PASS, width=WIDTH,
+	             height=HEIGHT, time_base='fraction', font_files=FONT_FILES,
+	             seed=None, scale=SCALE, aspect=None, max_danmaku=None):
+		assert pass_number in {0, 1, 2}, 'invalid pass number'
+		self.start_time = start_time
+		self.pass_number = pass_number
+		self.width = width
+		self.height = height
+		self.time_base = time_base
+		self.font_files = OrderedDict(font_files)
+		self.seed = seed
+		self.scale = scale
+		self.aspect = aspect
+		self.max_danmaku = max_danmaku
+		self.ticks = TIME_BASES[time_base]
+		x, y = width * scale, height * scale
+		if aspect is not None:
+			aspect = Fraction(aspect)
+			if x < y * aspect:
+				x = y * aspect
+			else:
+				y = x / aspect
+		self.play_res = round(x), round(y)
+		self.offset = ((Fraction(self.play_res[0]) / scale - width) / 2,
+		               (Fraction(self.play_res[1]) / scale - height) / 2)
+	def replace(self, **changes):
+		"""C.replace(**changes) -> Config
+
+Return a copy of the configuration with some settings changed."""
+		settings = {name: getattr(self, name) for name in self._SETTINGS}
+		settings.update(changes)
+		return Config(**settings)
+	@property
+	def question_size(self):
+		if self.pass_number <= 1:
+			return QUESTION_MAX_SIZE
+		return QUESTION_MIN_SIZE * Fraction(2, 3)
+	@property
+	def yugi_scale(self):
+		return 100 if self.pass_number <= 1 else 99
+	def seconds(self, n, unit=1):
+		"""C.seconds(n, unit=1) -> timestamp
+
+Convert n units of 1/unit seconds to the configured time base."""
+		if self.ticks == 1:
+			return Fraction(n, unit)
+		ticks, remainder = divmod(n * self.ticks, unit)
+		assert not remainder, 'time is not a whole number of ticks'
+		return int(ticks)
+	def time(self, s):
+		"""C.time(s) -> str
+
+Format a timestamp in the configured time base for ASS."""
+		# Round to centiseconds, half to even like round()
+		cs, remainder = divmod(max(s, 0) * 100, self.ticks)
+		if remainder * 2 > self.ticks or remainder * 2 == self.ticks and cs & 1:
+			cs += 1
+		s, cs = divmod(cs, 100)
+		m, s = divmod(s, 60)
+		h, m = divmod(m, 60)
+		return '%d:%02d:%02d.%02d' % (h, m, s, cs)
+	def x(self, x):
+		"""C.x(x) -> str
+
+Format a horizontal position in layout pixels as a PlayRes one for ASS."""
+		if self.offset[0]:
+			x += self.offset[0]
+		return number(x * self.scale)
+	def y(self, y):
+		"""C.y(y) -> str
+
+Format a vertical position in layout pixels as a PlayRes one for ASS."""
+		if self.offset[1]:
+			y += self.offset[1]
+		return number(y * self.scale)
+
+def use_fonts(config):
+	"""use_fonts(config)
+
+Make FONTS the fonts in config.font_files. Each set of font files
+is only opened once per process, along with its glyph metrics
+and font runs caches."""
+	global FONTS, _glyph_metrics, _font_runs_cache
+	key = tuple(config.font_files.items())
+	if key not in _font_sets:
+		_font_sets[key] = load_fonts(config.font_files), {}, OrderedDict()
+	FONTS, _glyph_metrics, _font_runs_cache = _font_sets[key]
+
+def font_for(c, font_name, pending=None):
+	"""font_for(c, font_name, pending=None) -> str or None
+
+Return the name of the font in FONTS that will render the character c
+(or the two-character r'\\{') in a comment when it follows a character
+rendered in font_name, which is None at the start of the comment.
+If no font has c, return None: VSFilter falls back to Arial then.
+Warnings are given, or added to pending, as with warn()."""
+	if c == r'\{':
+		return 'Arial'
+	# Variation Selectors block
+	if 0xFE00 <= ord(c) <= 0xFE0F:
+		if font_name is None:
+			# Not sure things like the ascender calculation
+			# will be correct either...
+			warn('lone', pending)
+			return 'Arial'
+		return font_name
+	if c == '\u263A':  # WHITE SMILING FACE
+		if font_name == 'MS PGothic':
+			# WTF, Windows
+			return font_name
+		return 'Arial'
+	for font_name, (style, face, sizes) in FONTS.items():
+		if face.get_char_index(c):
+			return font_name
+	warn('fonts', pending)
+	return None
+
+# (advance, left, right) in 1/8 layout pixels by (font name, fs, character)
+# for FONTS
+_glyph_metrics = None
+
+FontRuns = namedtuple('FontRuns', ('first', 'runs', 'ascender', 'style',
+                                   'chars', 'warnings'))
+
+# FontRuns by (text, size) for FONTS, most recently used last
+_font_runs_cache = None
+
+def font_runs(text, size):
+	"""font_runs(text, size) -> FontRuns
+
+Split the text of a danmaku chat of a size into runs by the font that will
+render them. R.runs is a list of text runs and of the override tags that
+switch fonts between them, each given as (head, colored, tail, fs): the tag
+is head, then the chat's color and alpha tags if colored, then tail, then
+\\fs for the font size fs in layout pixels unless fs is None. R.first
+is the tag for the first run, which goes with the position; R.style is the
+ASS style to use; R.ascender is the highest ascender of any character,
+and R.chars lists (font name, characters) used. The results for the
+FONT_RUNS_CACHE_SIZE most recently used texts are kept, and the warnings
+in R.warnings are given again whenever one is used."""
+	key = text, size
+	try:
+		runs = _font_runs_cache[key]
+	except KeyError:
+		counters['font run splits'] += 1
+		runs = _font_runs_cache[key] = _font_runs(text, size)
+		if len(_font_runs_cache) > FONT_RUNS_CACHE_SIZE:
+			_font_runs_cache.popitem(last=False)
+	else:
+		counters['font run cache hits'] += 1
+		_font_runs_cache.move_to_end(key)
+	for warning in runs.warnings:
+		warn(warning)
+	return runs
+
+def _font_runs(text, size):
+	warnings = []
+	chars = OrderedDict()
+	font = None
+	fs = None
+	runs = []
+	braces = problematic_braces = False
+	ascender = 0
+	font_name = None
+	for match in re.finditer(r'(?s)\\\{|.', text):
+		c = match.group()
+		font_name = font_for(c, font_name, warnings)
+		if c == r'\{':
+			chars.setdefault(font_name, set()).add('{')
+		elif font_name is None:
+			# Not in any font, so not worth subsetting Arial for
+			font_name = 'Arial'
+		# Variation Selectors block
+		elif not 0xFE00 <= ord(c) <= 0xFE0F:
+			chars.setdefault(font_name, set()).add(c)
+		style, extra_font, sizes = FONTS[font_name]
+		if font is not extra_font:
+			if style is not None:
+				head, colored, tail = r'\r' + style, True, ''
+				fs = sizes[SIZE]['fs']
+			else:
+				head, colored, tail = '', font is None, r'\fn' + font_name
+			run_fs = sizes[size]['fs'] if sizes[size]['fs'] != fs else None
+			fs = sizes[size]['fs']
+			if runs and runs[-1] == '\\':
+				runs.append('\u200b')
+			runs.append((head, colored, tail, run_fs))
+			problematic_braces |= braces
+			font = extra_font
+		elif c == '}':
+			problematic_braces |= braces
+		if c == r'\{':
+			braces = True
+		runs.append(c)
+		ascender = max(ascender, sizes[size]['asc'])
+	if problematic_braces:
+		warnings.append('braces')
+		chars.setdefault('Arial', set()).add('\\')
+	for i in range(len(runs) - 1, -1, -1):
+		if not isinstance(runs[i], str) or runs[i].endswith('}'):
+			break
+		elif runs[i] == r'\{':
+			runs[i] = '{'
+
+	savings = {'a': 0, 'g': 0}
+	for run in runs:
+		if not isinstance(run, str) and run[0].startswith(r'\r'):
+			savings[run[0][2]] += 1
+	if runs[0][0].startswith(r'\r'):
+		savings[runs[0][0][2]] += 2
+	style = max(savings, key=savings.__getitem__)
+	for i, run in enumerate(runs):
+		if not isinstance(run, str) and run[0] == r'\r' + style:
+			runs[i] = (r'\r',) + run[1:]
+	first = runs[0]
+	if first[0] == r'\r':
+		first = ('',) + first[1:]
+
+	# Join the characters between tags into runs
+	joined = []
+	for run in runs[1:]:
+		if isinstance(run, str) and joined and isinstance(joined[-1], str):
+			joined[-1] += run
+		else:
+			joined.append(run)
+	return FontRuns(first, joined, ascender, style,
+	                tuple((font_name, frozenset(font_chars))
+	                      for font_name, font_chars in chars.items()),
+	                tuple(warnings))
+
+def glyph_metrics(font_name, fs, c):
+	key = font_name, fs, c
+	try:
+		return _glyph_metrics[key]
+	except KeyError:
+		pass
+	style, face, sizes = FONTS[font_name]
+	face.load_char(c, _import('freetype').FT_LOAD_NO_SCALE)
+	metrics = face.glyph.metrics
+	# GDI scales the font so that its ascender plus descender equals fs
+	scale = Fraction(fs * 8, face.ascender - face.descender)
+	metrics = (round(metrics.horiAdvance * scale),
+	           math.floor(metrics.horiBearingX * scale),
+	           math.ceil((metrics.horiBearingX + metrics.width) * scale))
+	_glyph_metrics[key] = metrics
+	return metrics
+
+def measure(text, size, font_name=None, outline=1):
+	"""measure(text, size, font_name=None, outline=1) -> (width, height)
+
+Compute the bounding box of ASS text as VSFilter would render it, in layout
+pixels, from FreeType glyph metrics. If font_name is None, the text is a
+comment rendered with font fallback at the nominal size; otherwise all of
+it is rendered in font_name with fs == size. outline is the border width."""
+	width = height = 0
+	pen = left = right = line_height = 0
+	current_font = None
+	for match in re.finditer(r'(?s)\{[^}]*\}|\\[Nnh{]|.', text):
+		c = match.group()
+		if c.startswith('{'):
+			continue
+		if c in {r'\N', r'\n'}:
+			width = max(width, right - left)
+			height += line_height
+			pen = left = right = line_height = 0
+			continue
+		if font_name is None:
+			current_font = font_for(c, current_font) or 'Arial'
+			sizes = FONTS[current_font][2][size]
+			fs = sizes['fs']
+			line_height = max(line_height, (sizes['asc'] + sizes['desc']) * 8)
+		else:
+			current_font = font_name
+			fs = size
+			line_height = max(line_height, fs * 8)
+		c = {r'\h': '\xa0', r'\{': '{'}.get(c, c)
+		advance, glyph_left, glyph_right = glyph_metrics(current_font, fs, c)
+		left = min(left, pen + glyph_left)
+		right = max(right, pen + glyph_right)
+		pen += advance
+		right = max(right, pen)
+	width = max(width, right - left)
+	height += line_height
+	return (Fraction(width, 8) + outline * 2,
+	        Fraction(height, 8) + outline * 2)
+
+def percentages(chat):
+	"""percentages(chat) -> list or None
+
+Return the percentage labels shown for the answers of a /vote showresult."""
+	if (chat.command != 'vote' or chat.mode != 'showresult' or
+	    chat.result_mode not in {'percent', 'per'}):
+		return None
+	total = sum(chat.results)
+	if not total:
+		return None
+	return ['%.1f%%' % round(result * 100 / total, 1) for result in chat.results]
+
+def measure_chats(chats):
+	"""measure_chats(chats)
+
+Set the sizes of all chats, vote answers and percentages the way
+PASS 1 renders them, but without rendering anything."""
+	for chat in chats:
+		if chat.command == 'vote' and chat.mode == 'stop':
+			continue
+		if chat.command is None:
+			chat.width, chat.height = measure(chat.text, chat.size)
+		elif chat.command == 'perm' or chat.command == 'vote' and chat.text:
+			chat.width, chat.height = measure(chat.text, SIZE, 'MS PGothic', 0)
+		if chat.command == 'vote':
+			chat.answer_sizes = [measure('%d:%s' % (i + 1, answer),
+			                             QUESTION_MAX_SIZE, 'MS PGothic')
+			                     for i, answer in enumerate(chat.answers)]
+			if chat.mode == 'showresult':
+				labels = percentages(chat) or ['' for answer in chat.answers]
+				chat.percentage_sizes = [measure(label, SIZE, 'MS PGothic')
+				                         for label in labels]
+
+def bounds_key(style, size, text, config):
+	"""bounds_key(style, size, text, config) -> str
+
+Return the cache key for the size of text rendered in PASS 1 in an ASS
+style (or 'danmaku' for comments with font fallback) at a font size with
+the fonts and the scale of config. Everything in the script that changes
+how big the text is goes into the key: the font files, the font sizes and
+style scale that the header gives, and the PlayRes scale."""
+	if style == 'danmaku':
+		font_names = list(FONTS)
+		style_scale = 100
+	else:
+		font_names = ['MS PGothic']
+		style_scale = (config.replace(pass_number=1).yugi_scale
+		               if style == 'y' else 100)
+	if style == 'v':
+		font_sizes = [size]
+	else:
+		font_sizes = [FONTS[name][2].get(size, {}).get('fs')
+		              for name in font_names]
+	key = '\0'.join((style,
+	                  repr([config.font_files[name] for name in font_names]),
+	                  repr(font_sizes), str(style_scale), str(config.scale),
+	                  text))
+	return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def set_bounds_keys(chat, config):
+	"""set_bounds_keys(chat, config)
+
+Set the cache keys for everything about chat that needs measuring."""
+	chat.bounds_key = None
+	if chat.command is None:
+		chat.bounds_key = bounds_key('danmaku', chat.size, chat.text, config)
+	elif chat.command == 'perm' or chat.command == 'vote' and chat.text:
+		chat.bounds_key = bounds_key('y', SIZE, chat.text, config)
+	if chat.command == 'vote' and chat.mode != 'stop':
+		chat.answer_keys = [bounds_key('v', QUESTION_MAX_SIZE,
+		                               '%d:%s' % (i + 1, answer), config)
+		                    for i, answer in enumerate(chat.answers)]
+		labels = percentages(chat)
+		if labels is not None:
+			chat.percentage_keys = [bounds_key('p', SIZE, label, config)
+			                        for label in labels]
+
+class BoundsCache:
+	"""BoundsCache(path)
+
+Text sizes from rendered PASS 1 output, keyed by bounds_key() and kept
+in an append-only file that is shared by all conversions and runs."""
+	__slots__ = '_path', '_offset', '_sizes', '_wanted'
+	def __init__(self, path):
+		self._path = path
+		self._offset = 0
+		self._sizes = {}
+		self._wanted = OrderedDict()
+		self._refresh()
+	def _refresh(self):
+		# Pick up whatever has been appended since the last read,
+		# possibly by other processes
+		try:
+			file = open(self._path, encoding='utf-8')
+		except FileNotFoundError:
+			return
+		with file:
+			file.seek(self._offset)
+			for line in iter(file.readline, ''):
+				if not line.endswith('\n'):
+					break
+				key, width, height = line.split()
+				self._sizes[key] = Fraction(width), Fraction(height)
+				self._offset = file.tell()
+	def __getitem__(self, key):
+		if key not in self._sizes:
+			self._refresh()
+		return self._sizes[key]
+	def want(self, key):
+		"""B.want(key) -> bool
+
+Return whether the text with this key should be rendered in PASS 1,
+that is, whether it is neither cached nor already wanted."""
+		if key in self._sizes or key in self._wanted:
+			return False
+		self._wanted[key] = None
+		return True
+	def save_wanted(self, path):
+		"""B.save_wanted(path)
+
+Write the keys of the texts rendered in PASS 1, in order. If there are
+none, there is no bounds file to ingest, so remove the file instead."""
+		if not self._wanted:
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			return
+		with open(path, 'w', encoding='utf-8') as file:
+			file.writelines(key + '\n' for key in self._wanted)
+	def ingest(self, keys, bounds):
+		"""B.ingest(keys, bounds)
+
+Add the sizes in a bounds file, rendered from PASS 1 output,
+for the keys that PASS 1 saved to the file keys, and remove the keys
+file once they are in the cache. Raise ValueError if the two files
+don't have a line for each text."""
+		with open(keys, encoding='utf-8') as file:
+			key_lines = file.read().splitlines()
+		with open(bounds, encoding='utf-8') as file:
+			bounds_lines = file.read().splitlines()
+		if len(key_lines) != len(bounds_lines):
+			raise ValueError('%s lists %d texts but %s has %d bounds; render '
+			                 '%s again from the output of the latest PASS 1'
+			                 % (keys, len(key_lines), bounds, len(bounds_lines),
+			                    bounds))
+		lines = []
+		for key, line in zip(key_lines, bounds_lines):
+			width, height = line.split()[1:]
+			if key not in self._sizes:
+				lines.append('%s %s %s\n' % (key, width, height))
+		if lines:
+			# Append in one go so that concurrent conversions don't interleave
+			with open(self._path, 'a', encoding='utf-8') as file:
+				file.write(''.join(lines))
+		self._refresh()
+		# The sizes are in the cache now: don't ingest them again
+		os.remove(keys)
+
+class Sink:
+	"""Sink(target=None, buffer_size=65536)
+
+Buffered destination for an ASS script. target is a file object, a path
+(compressed with gzip if it ends with .gz) or, if None or '-', stdout.
+Text is collected and written out in large chunks; the number of events
+and of bytes (in UTF-8) written so far are kept in S.events and S.bytes."""
+	__slots__ = ('_file', '_owned', '_binary', '_buffer', '_buffered',
+	             '_buffer_size', 'events', 'bytes')
+	def __init__(self, target=None, buffer_size=65536):
+		self._owned = isinstance(target, str) and target != '-'
+		if not self._owned:
+			self._file = sys.stdout if target in {None, '-'} else target
+		elif target.endswith('.gz'):
+			self._file = _import('gzip').open(target, 'wb')
+		else:
+			self._file = open(target, 'wb')
+		self._binary = not isinstance(self._file, io.TextIOBase)
+		self._buffer = []
+		self._buffered = 0
+		self._buffer_size = buffer_size
+		self.events = 0
+		self.bytes = 0
+	def write(self, text):
+		"""S.write(text)
+
+Add text to the script as it is."""
+		self._buffer.append(text)
+		self._buffered += len(text)
+		if self._buffered >= self._buffer_size:
+			self.flush()
+	def event(self, line):
+		"""S.event(line)
+
+Add one event line to the script."""
+		self.events += 1
+		self.write(line + '\n')
+	def flush(self):
+		"""S.flush()
+
+Write out everything buffered so far."""
+		text = ''.join(self._buffer)
+		self._buffer.clear()
+		self._buffered = 0
+		data = text.encode('utf-8')
+		self.bytes += len(data)
+		self._file.write(data if self._binary else text)
+		self._file.flush()
+	def close(self):
+		"""S.close()
+
+Flush the sink and close its file if the sink opened it."""
+		self.flush()
+		if self._owned:
+			self._file.close()
+	def __enter__(self):
+		return self
+	def __exit__(self, *exc_info):
+		self.close()
+
+class SortedSink(Sink):
+	"""SortedSink(target=None, segment=None, index=None, index_step=INDEX_STEP)
+
+Sink that holds the events of an ASS script and, when closed, writes them
+to target in order of start time, which renderers load and seek through
+faster; events that start together keep their order. If segment is not
+None, the script is split into one file for every segment seconds instead,
+named after the path target with the number of the segment before the
+extension (see S.segment_path()). Each has the whole header and every event
+shown during its time span. If index is not None, a JSON index of the
+files is written to that path: their paths (relative to the index), their
+time spans and, for every index_step seconds, the byte offset (of the
+uncompressed text) from which a player that seeks there needs to read
+events. S.events counts events as they come and S.bytes counts bytes
+once they are written. Closing it again does nothing."""
+	__slots__ = ('_target', '_segment', '_index', '_index_step', '_header',
+	             '_lines', '_closed')
+	def __init__(self, target=None, segment=None, index=None,
+	             index_step=INDEX_STEP):
+		if segment is not None and not isinstance(target, str):
+			raise ValueError('splitting a script needs a path')
+		self._target = target
+		self._segment = None if segment is None else round(segment * 100)
+		self._index = index
+		self._index_step = round(index_step * 100)
+		self._header = []
+		self._lines = []
+		self._closed = False
+		self.events = 0
+		self.bytes = 0
+	def write(self, text):
+		self._header.append(text)
+	def event(self, line):
+		self.events += 1
+		# Dialogue: Layer,Start,End,...
+		start, end = (centiseconds(time)
+		              for time in line.split(',', 3)[1:3])
+		self._lines.append((start, end, line + '\n'))
+	def flush(self):
+		"""S.flush()
 
-print('''[Script Info]
+Do nothing: the events can only be written once they are all known."""
+	def segment_path(self, n):
+		"""S.segment_path(n) -> str
+
+Return the path of the n-th segment."""
+		base, gz = self._target, ''
+		if base.endswith('.gz'):
+			base, gz = base[:-3], '.gz'
+		base, extension = os.path.splitext(base)
+		return '%s.%04d%s%s' % (base, n, extension, gz)
+	def close(self):
+		"""S.close()
+
+Write out the sorted events and the index."""
+		if self._closed:
+			return
+		self._closed = True
+		header = ''.join(self._header)
+		lines = sorted(self._lines, key=operator.itemgetter(0))
+		self._lines.clear()
+		if self._segment is None:
+			last = max((max(start, end) for start, end, line in lines),
+			           default=0)
+			files = [(self._target, 0, last, lines)]
+		else:
+			# Each event goes in every segment that shows it
+			segments = [[]]
+			for event in lines:
+				start, end = event[:2]
+				first = start // self._segment
+				last = max(first, (end - 1) // self._segment)
+				while len(segments) <= last:
+					segments.append([])
+				for n in range(first, last + 1):
+					segments[n].append(event)
+			files = [(self.segment_path(n), n * self._segment,
+			          (n + 1) * self._segment, events)
+			         for n, events in enumerate(segments)]
+		index = []
+		for target, begin, end, events in files:
+			with Sink(target) as sink:
+				sink.write(header)
+				for start, stop, line in events:
+					sink.write(line)
+			self.bytes += sink.bytes
+			index.append(self._index_entry(target, begin, end, events,
+			                               len(header.encode('utf-8'))))
+		if self._index is not None:
+			with open(self._index, 'w', encoding='utf-8') as file:
+				_import('json').dump({
+					'segment': (None if self._segment is None
+					            else self._segment / 100),
+					'step': self._index_step / 100,
+					'files': index,
+				}, file, indent='\t')
+	def _index_entry(self, target, begin, end, events, offset):
+		# The events needed from time t on are those from the first one
+		# that is still shown at t: the first whose running maximum
+		# end time is past t
+		offsets = [offset]
+		stops = []
+		for start, stop, line in events:
+			offset += len(line.encode('utf-8'))
+			offsets.append(offset)
+			stops.append(max(stop, stops[-1]) if stops else stop)
+		bisect_right = _import('bisect').bisect_right
+		return OrderedDict((
+			('file', os.path.relpath(target, os.path.dirname(
+			             os.path.abspath(self._index)))
+			         if isinstance(target, str) and self._index is not None
+			         else None),
+			('start', begin / 100),
+			('end', end / 100),
+			('events', len(events)),
+			('bytes', offsets[-1]),
+			('offsets', [[t / 100, offsets[bisect_right(stops, t)]]
+			             for t in range(begin, max(end, begin + 1),
+			                            self._index_step)]),
+		))
+
+def index_path(path):
+	"""index_path(path) -> str
+
+Return the path of the index (see SortedSink) of a script at path."""
+	if path.endswith('.gz'):
+		path = path[:-3]
+	return os.path.splitext(path)[0] + '.index.json'
+
+def centiseconds(time):
+	"""centiseconds(time) -> int
+
+Parse an ASS timestamp H:MM:SS.CC as written by Config.time()."""
+	h, m, s = time.split(':')
+	s, cs = s.split('.')
+	return ((int(h) * 60 + int(m)) * 60 + int(s)) * 100 + int(cs)
+
+def load_chats(file, config):
+	"""load_chats(file, config) -> list of Chat
+
+Read the chats in a NicoNico comment XML file (a path or a file object),
+sorted by vstart."""
+	try:
+		chats = list(read_chats(file, config))
+	except (AssertionError, ElementTree.ParseError) as e:
+		sys.exit('This is not a valid NicoNico comment XML file: ' + str(e))
+
+	chats.sort(key = lambda chat: chat.vstart)
+	return chats
+
+def resolve_timing(chats):
+	"""resolve_timing(chats)
+
+Cut each /perm and /vote short when the next one or a /clear comes,
+and let each vote's answers stay until the next vote command."""
+	if not chats:
+		return
+	max_vend = max(chat.vend for chat in chats)
+
+	# TODO: priorities
+	last = None
+	last_vote = None
+	for chat in chats:
+		if chat.command == 'vote':
+			if chat.mode == 'showresult':
+				chat.answers = last_vote.answers
+			if last_vote is not None:
+				last_vote.vote_vend = min(last_vote.vote_vend, chat.vstart)
+			if chat.mode == 'stop':
+				if last is not None:
+					last.vend = min(last.vend, chat.vstart)
+					last = None
+				last_vote = None
+			else:
+				chat.vote_vend = max_vend
+				last_vote = chat
+			if not chat.text:
+				continue
+		if chat.command in {'perm', 'vote'}:
+			if last is not None:
+				last.vend = min(last.vend, chat.vstart)
+			if not chat.expire:
+				chat.vend = max_vend
+			last = chat
+		elif chat.command in {'clear', 'cls'}:
+			if last is not None:
+				last.vend = min(last.vend, chat.vstart)
+				last = None
+
+def danmaku_priority(chat):
+	"""danmaku_priority(chat) -> tuple
+
+Return how much a danmaku chat should be kept over others when too many
+are on screen, as a tuple that sorts higher for chats to keep first:
+(not deleted, score, by staff, by a premium user, size). So deleted chats
+matter least, then those with the lowest (most negative) scores; among
+equal scores, chats by staff, then by premium users, then bigger chats are
+kept first. (Operator comments always have a command, so they are never
+danmaku.)"""
+	return not chat.deleted, chat.score, chat.staff, chat.premium, chat.size
+
+def decimate(chats, config):
+	"""decimate(chats, config)
+
+If config.max_danmaku is not None, remove danmaku from the list chats in
+PASS 2, so that at most that many of each vertical alignment are on
+screen during any 1/LAYOUT_RESOLUTION s. Danmaku are kept in order of
+danmaku_priority(), the earlier one first among equals, as long as
+they fit. How many were dropped is printed and counted."""
+	budget = config.max_danmaku
+	if budget is None or config.pass_number != 2:
+		return
+	resolution = Fraction(LAYOUT_RESOLUTION, config.ticks)
+	numerator, denominator = resolution.numerator, resolution.denominator
+	danmaku = [(n, chat) for n, chat in enumerate(chats)
+	           if chat.command is None]
+	# Sorting is stable even in reverse, so earlier chats stay first
+	danmaku.sort(key=lambda item: danmaku_priority(item[1]), reverse=True)
+	# How many kept danmaku are on screen in each window, by valign
+	shown = {}
+	dropped = set()
+	dropped_by_valign = Counter()
+	for n, chat in danmaku:
+		first = chat.vstart * numerator // denominator
+		last = -(-chat.vend * numerator // denominator)
+		windows = range(first, max(last, first + 1))
+		counts = shown.setdefault(chat.valign, Counter())
+		if any(counts[window] >= budget for window in windows):
+			dropped.add(n)
+			dropped_by_valign[chat.valign] += 1
+			if chat.deleted:
+				counters['deleted danmaku dropped'] += 1
+			elif chat.score < 0:
+				counters['negative score danmaku dropped'] += 1
+		else:
+			for window in windows:
+				counts[window] += 1
+	counters['danmaku dropped'] += len(dropped)
+	for valign, count in dropped_by_valign.items():
+		counters['%s danmaku dropped' % valign] += count
+	if dropped:
+		chats[:] = [chat for n, chat in enumerate(chats) if n not in dropped]
+		print('Dropped %d of %d danmaku to show at most %d at a time '
+		      'of each kind: %s.' %
+		      (len(dropped), len(danmaku), budget,
+		       ', '.join('%d %s' % (dropped_by_valign[valign], name)
+		                 for valign, name in (('normal', 'scrolling'),
+		                                      ('top', 'at the top'),
+		                                      ('bottom', 'at the bottom')))),
+		      file=sys.stderr)
+
+class _Span:
+	__slots__ = 'lines', 'start', 'end'
+	def __init__(self, lines, start, end):
+		self.lines = lines
+		self.start = start
+		self.end = end
+
+class LiveTiming:
+	"""LiveTiming(config, sink, segment)
+
+Incremental counterpart of resolve_timing() for follow(). How long a /perm
+or /vote stays on screen is not known until the next one (or a /clear)
+comes, so its events are kept and written to the Sink in segments: each
+time the stream has moved on by segment, they are written up to there."""
+	__slots__ = ('_config', '_sink', '_segment', '_open', '_text', '_vote',
+	             '_answers', 'max_vend')
+	def __init__(self, config, sink, segment):
+		self._config = config
+		self._sink = sink
+		self._segment = segment
+		self._open = []
+		self._text = None
+		self._vote = None
+		self._answers = None
+		# The latest vend of any chat read so far
+		self.max_vend = None
+	def add(self, chat, chars):
+		"""LT.add(chat, chars)
+
+Cut short whatever chat replaces, then measure and render chat itself,
+adding the characters it uses to chars."""
+		if chat.command == 'vote':
+			if chat.mode == 'showresult':
+				chat.answers = self._vote.answers
+			self._cut(self._answers, chat.vstart)
+			self._answers = None
+			if chat.mode == 'stop':
+				self._cut(self._text, chat.vstart)
+				self._text = None
+				self._vote = None
+			else:
+				self._vote = chat
+		if chat.command == 'perm' or chat.command == 'vote' and chat.text:
+			self._cut(self._text, chat.vstart)
+			self._text = None
+		elif chat.command in {'clear', 'cls'}:
+			self._cut(self._text, chat.vstart)
+			self._text = None
+		if chat.command not in {'perm', 'vote'}:
+			return
+
+		measure_chats([chat])
+		if chat.command == 'vote' and chat.mode != 'stop':
+			# Only a placeholder: segments replace the times of every line
+			chat.vote_vend = chat.vend
+		output = io.StringIO()
+		sink = Sink(output)
+		render_chat(chat, self._config, sink, chars)
+		sink.flush()
+		# Layer 2 is the /perm (or question) box, layer 1 the vote answers
+		text, answers = [], []
+		for line in output.getvalue().splitlines():
+			layer, start, end, rest = line.split(',', 3)
+			(text if layer.endswith('2') else answers).append((layer, rest))
+		if chat.command == 'perm' or chat.text:
+			self._text = _Span(text, chat.vstart,
+			                   chat.vend if chat.expire else None)
+			self._open.append(self._text)
+		if chat.command == 'vote' and chat.mode != 'stop':
+			self._answers = _Span(answers, chat.vstart, None)
+			self._open.append(self._answers)
+	def advance(self, vpos):
+		"""LT.advance(vpos)
+
+Write out everything that is on screen up to vpos."""
+		for span in list(self._open):
+			if span.end is not None and span.end <= vpos:
+				self._close(span, span.end)
+			elif vpos - span.start >= self._segment:
+				self._write(span, vpos)
+				span.start = vpos
+	def finish(self):
+		"""LT.finish()
+
+Write out the rest of everything, as the stream has ended."""
+		for span in list(self._open):
+			self._close(span, self.max_vend if span.end is None else span.end)
+	def _cut(self, span, vpos):
+		if span is None or span not in self._open:
+			return
+		if span.end is not None:
+			vpos = min(span.end, vpos)
+		# Chats that come too late for the window may be earlier still
+		self._close(span, max(vpos, span.start))
+	def _close(self, span, vend):
+		self._write(span, vend)
+		self._open.remove(span)
+	def _write(self, span, vend):
+		start, end = self._config.time(span.start), self._config.time(vend)
+		for layer, rest in span.lines:
+			self._sink.event('%s,%s,%s,%s' % (layer, start, end, rest))
+
+def measure_sizes(chats, config, measurement='bounds', bounds='bounds.txt',
+                  bounds_cache='bounds-cache.txt'):
+	"""measure_sizes(chats, config, measurement='bounds', bounds='bounds.txt', bounds_cache='bounds-cache.txt') -> BoundsCache or None
+
+Set the sizes of the chats (see convert() for the measurement methods).
+The bounds cache is returned if one is used."""
+	use_fonts(config)
+	if config.pass_number <= 1:
+		for chat in chats:
+			if chat.command == 'vote' and chat.mode == 'stop':
+				continue
+			if chat.command in {None, 'perm', 'vote'}:
+				chat.width, chat.height = Fraction('39'), Fraction('26.875')
+			if chat.command == 'vote' and chat.mode != 'stop':
+				chat.answer_sizes = [(Fraction('39'), Fraction('36'))
+				                     for answer in chat.answers]
+				if chat.mode == 'showresult':
+					chat.percentage_sizes = chat.answer_sizes
+	cache = None
+	if measurement == 'freetype':
+		if config.pass_number == 2:
+			measure_chats(chats)
+	elif config.pass_number != 0:
+		cache = BoundsCache(bounds_cache)
+		keys = os.path.splitext(bounds)[0] + '.keys'
+		if config.pass_number == 2 and os.path.exists(keys):
+			try:
+				cache.ingest(keys, bounds)
+			except ValueError as e:
+				sys.exit(str(e))
+		missing = 0
+		for chat in chats:
+			if chat.command == 'vote' and chat.mode == 'stop':
+				continue
+			set_bounds_keys(chat, config)
+			if config.pass_number <= 1:
+				continue
+			try:
+				if chat.bounds_key is not None:
+					chat.width, chat.height = cache[chat.bounds_key]
+				if chat.command == 'vote':
+					chat.answer_sizes = [cache[key] for key in chat.answer_keys]
+					if chat.mode == 'showresult':
+						chat.percentage_sizes = [cache[key] for key in
+						                         getattr(chat, 'percentage_keys', ())]
+			except KeyError:
+				missing += 1
+		if missing:
+			sys.exit('%d comments have not been measured. Run PASS 1 '
+			         'and render its output to %s first.' % (missing, bounds))
+	return cache
+
+def lay_out(chats, config, jobs=None):
+	"""lay_out(chats, config, jobs=None)
+
+Set the heights and vertical positions of the danmaku chats. In PASS 2,
+they are moved out of each other's way; until then, all are at the top
+(or the bottom). If jobs is not None, PASS 2 is done in that many
+processes by lay_out_sharded()."""
+	if not chats:
+		return
+	danmaku = []
+	for n, chat in enumerate(chats):
+		if chat.command is None:
+			position(chat, config)
+			danmaku.append((n, chat))
+	if config.pass_number != 2 or not danmaku:
+		return
+	if jobs is not None:
+		lay_out_sharded(danmaku, config, jobs)
+		return
+	layout = Layout(min(chat.vstart for chat in chats),
+	                max(chat.vend for chat in chats), config)
+	for n, chat in danmaku:
+		layout.place(chat, chat_random(config.seed, n))
+
+def lay_out_sharded(danmaku, config, jobs=None, shard=SHARD_SECONDS,
+                    margin=SHARD_MARGIN):
+	"""lay_out_sharded(danmaku, config, jobs=None, shard=SHARD_SECONDS, margin=SHARD_MARGIN)
+
+Lay out danmaku, a list of (n, chat) in order of vstart, where chat is the
+n-th of all chats and has been positioned, the same way as one Layout
+would, but in a pool of jobs processes (by default, one per CPU). The timeline is cut into
+shards of shard seconds, and each is laid out starting margin seconds
+early, so that by the seam the layout has usually settled on the same
+positions as the shard before it. Where it has not, the shard is laid out
+again from the seam until it has. Random heights come from
+chat_random(config.seed, n), with a seed of 0 if it is None."""
+	assert margin >= 5, 'the margin must cover the longest danmaku'
+	seed = 0 if config.seed is None else config.seed
+	vstarts = [chat.vstart for n, chat in danmaku]
+	shard, margin = config.seconds(shard), config.seconds(margin)
+	begins = [0]
+	for i in range(1, len(danmaku)):
+		if ((vstarts[i] - vstarts[0]) // shard !=
+		    (vstarts[i - 1] - vstarts[0]) // shard):
+			begins.append(i)
+	ends = begins[1:] + [len(danmaku)]
+	warms = [_import('bisect').bisect_left(vstarts, vstarts[begin] - margin)
+	         for begin in begins]
+	work = [(config, seed, danmaku[warm:end])
+	        for warm, end in zip(warms, ends)]
+	with _import('multiprocessing').Pool(jobs) as pool:
+		results = pool.map(_lay_out_shard, work)
+
+	for begin, end, warm, (positions, shard_counters) in \
+	    zip(begins, ends, warms, results):
+		counters.update(shard_counters)
+		# Which of the chats before the seam the shard got wrong
+		diverged = [chat for (n, chat), position
+		            in zip(danmaku[warm:begin], positions)
+		            if (chat.y, chat.alpha) != position]
+		layout = None
+		for i in range(begin, end):
+			n, chat = danmaku[i]
+			diverged = [previous_chat for previous_chat in diverged
+			            if previous_chat.vend > chat.vstart]
+			if not diverged:
+				# Everything on screen is where the shard has it,
+				# so the shard is right from here on
+				for (n, chat), (y, alpha) in zip(danmaku[i:end],
+				                                 positions[i - warm:]):
+					chat.y, chat.alpha = y, alpha
+				break
+			if layout is None:
+				counters['shard seams reconciled'] += 1
+				layout = ActiveLayout(config)
+				for _, previous_chat in danmaku[warm:begin]:
+					previous_chat.move(config)
+					layout._add(previous_chat)
+			counters['chats laid out again'] += 1
+			chat.alpha = 1
+			position(chat, config)
+			layout.place(chat, chat_random(seed, n))
+			if (chat.y, chat.alpha) != positions[i - warm]:
+				diverged.append(chat)
+
+def _lay_out_shard(job):
+	config, seed, danmaku = job
+	counters.clear()
+	layout = ActiveLayout(config)
+	for n, chat in danmaku:
+		layout.place(chat, chat_random(seed, n))
+	return [(chat.y, chat.alpha) for n, chat in danmaku], counters
+
+def chat_random(seed, n):
+	"""chat_random(seed, n) -> random number generator
+
+Return where the random height of the n-th chat is drawn from: the
+random module itself if seed is None, or else a generator seeded with both,
+so that the chat gets the same height whichever process lays it out."""
+	if seed is None:
+		return random
+	return random.Random('%s/%d' % (seed, n))
+
+def position(chat, config):
+	"""position(chat, config)
+
+Set the height of a danmaku chat and put it at the top of the screen
+(or the bottom), where laying it out starts."""
+	chat.height = LINE_HEIGHT[chat.size]
+	if chat.valign == 'bottom':
+		chat.y = config.height - chat.height
+	else:
+		chat.y = 0
+
+def render(chats, config, sink, cache=None):
+	"""render(chats, config, sink, cache=None) -> dict
+
+Write the ASS script for measured and laid out chats to a Sink and return
+the characters used from each font. In PASS 1, cache is the bounds cache
+if one is used, and only the texts that it wants are written."""
+	render_header(config, sink)
+	chars = {name: set() for name in FONTS}
+
+	# In PASS 1, only output what still needs to be measured
+	if config.pass_number != 1:
+		cache = None
+	for chat in chats:
+		render_chat(chat, config, sink, chars, cache)
+	return chars
+
+def render_header(config, sink):
+	"""render_header(config, sink)
+
+Write the script info and styles of the ASS script to a Sink."""
+	use_fonts(config)
+	sink.write('''[Script Info]
 ScriptType: v4.00+
 Language: ja
-LayoutResX: {WIDTH}
-LayoutResY: {HEIGHT}
+LayoutResX: {LAYOUT_RES_X}
+LayoutResY: {LAYOUT_RES_Y}
 PlayResX: {PLAY_RES_X}
 PlayResY: {PLAY_RES_Y}
 ScaledBorderAndShadow: yes
@@ -1110,95 +2709,93 @@ WrapStyle: 2
 
 [V4+ Styles]
 Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: a,Arial,{ARIAL_SIZE},&HFFFFFF,0,&H77000000,0,-1,0,0,0,100,100,0,0,1,13,0,8,0,0,0,1
-Style: g,MS PGothic,{MS_PGOTHIC_SIZE},&HFFFFFF,0,&H77000000,0,-1,0,0,0,100,100,0,0,1,13,0,8,0,0,0,1
-Style: v,MS PGothic,{QUESTION_SIZE},&H4DFFFFFF,0,&HA0000000,0,0,0,0,0,100,100,0,0,1,13,0,5,0,0,0,1
-Style: p,MS PGothic,{MS_PGOTHIC_SIZE},&H4D00FFFF,0,&HA0000000,0,0,0,0,0,100,100,0,0,1,13,0,2,0,0,0,1
+Style: a,Arial,{ARIAL_SIZE},&HFFFFFF,0,&H77000000,0,-1,0,0,0,100,100,0,0,1,{OUTLINE},0,8,0,0,0,1
+Style: g,MS PGothic,{MS_PGOTHIC_SIZE},&HFFFFFF,0,&H77000000,0,-1,0,0,0,100,100,0,0,1,{OUTLINE},0,8,0,0,0,1
+Style: v,MS PGothic,{QUESTION_SIZE},&H4DFFFFFF,0,&HA0000000,0,0,0,0,0,100,100,0,0,1,{OUTLINE},0,5,0,0,0,1
+Style: p,MS PGothic,{MS_PGOTHIC_SIZE},&H4D00FFFF,0,&HA0000000,0,0,0,0,0,100,100,0,0,1,{OUTLINE},0,2,0,0,0,1
 Style: y,MS PGothic,{MS_PGOTHIC_SIZE},&H66FFFFFF,0,0,0,0,0,0,0,{YUGI_SCALE},{YUGI_SCALE},0,0,1,0,0,4,0,0,0,1
 Style: r,,0,&H4DD89485,0,0,0,0,0,0,0,100,100,0,0,1,0,0,5,0,0,0,1
 Style: l,,0,&H4DFFFFFF,0,0,0,0,0,0,0,100,100,0,0,1,0,0,5,0,0,0,1
 Style: b,,0,&H66000000,0,0,0,0,0,0,0,100,100,0,0,1,0,0,5,0,0,0,1
-Style: m,,0,&H66000000,0,&H66373737,0,0,0,0,0,100,100,0,0,1,14,0,5,0,0,0,1
+Style: m,,0,&H66000000,0,&H66373737,0,0,0,0,0,100,100,0,0,1,{BOX_OUTLINE},0,5,0,0,0,1
 
 [Events]
 Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text'''
-.format(WIDTH = WIDTH,
-        HEIGHT = HEIGHT,
-        PLAY_RES_X = WIDTH * 13,
-        PLAY_RES_Y = HEIGHT * 13,
-        ARIAL_SIZE = number(FONTS['Arial'][2][SIZE]['fs'] * 13),
-        MS_PGOTHIC_SIZE = number(FONTS['MS PGothic'][2][SIZE]['fs'] * 13),
-        QUESTION_SIZE = number(QUESTION_SIZE * 13),
-        YUGI_SCALE = number(YUGI_SCALE)))
-
-chars = {name: set() for name in FONTS}
-
-tree = SegmentTree(math.floor(min(chat.vstart for chat in chats)),
-                   math.ceil(max(chat.vend for chat in chats)))
-for chat in chats:
+	.format(LAYOUT_RES_X = round(config.play_res[0] / config.scale),
+	        LAYOUT_RES_Y = round(config.play_res[1] / config.scale),
+	        PLAY_RES_X = config.play_res[0],
+	        PLAY_RES_Y = config.play_res[1],
+	        ARIAL_SIZE = number(FONTS['Arial'][2][SIZE]['fs'] * config.scale),
+	        MS_PGOTHIC_SIZE = number(FONTS['MS PGothic'][2][SIZE]['fs'] *
+	                                 config.scale),
+	        QUESTION_SIZE = number(config.question_size * config.scale),
+	        OUTLINE = number(config.scale),
+	        BOX_OUTLINE = number(YUGI_OUTLINE * config.scale),
+	        YUGI_SCALE = number(config.yugi_scale)) + '\n')
+
+def render_chat(chat, config, sink, chars, cache=None):
+	"""render_chat(chat, config, sink, chars, cache=None)
+
+Write the events for one measured and laid out chat to a Sink and add the
+characters it uses to chars, a dict of sets by font name. If cache is
+a bounds cache, only the texts that it wants are written."""
 	if chat.command in {'perm', 'vote'}:
-		if PASS <= 1:
-			chat.vstart, chat.vend = 0, 10
+		if config.pass_number <= 1:
+			chat.vstart, chat.vend = config.seconds(0), config.seconds(10)
 		if chat.command == 'perm' or chat.text:
-			# FIXME: go from hardcoded sizes and coordinates to honoring WIDTH and HEIGHT
-			print(r'Dialogue: 2,%s,%s,b,,0,0,0,,{\pos(%s,%s)\p1}m 0 0 l %d 0 %d %d 0 %d' %
-			      (time(chat.vstart), time(chat.vend),
-			       number(WIDTH * 13 / 2), number(YUGI_HEIGHT * 13 / 2),
-			       WIDTH * 13, WIDTH * 13,
-			       round(YUGI_HEIGHT * 13), round(YUGI_HEIGHT * 13)))
-			print(r'Dialogue: 2,%s,%s,m,,0,0,0,,{\pos(%s,%s)\p1}m 0 0 l 8710 0 8710 700 0 700' %
-			      (time(chat.vstart), time(chat.vend),
-			       number(WIDTH * 13 / 2), number(YUGI_HEIGHT * 13 / 2)))
-			scale = min(672 / chat.width, 56 / chat.height, 1) - Fraction('0.01')
-			override = r'\pos(%s,364)' % number((672 - chat.width * scale) * 13 / 2)
+			if cache is None:
+				center = (config.x(Fraction(config.width, 2)),
+				          config.y(Fraction(YUGI_HEIGHT, 2)))
+				width = round(config.width * config.scale)
+				height = round(YUGI_HEIGHT * config.scale)
+				sink.event(r'Dialogue: 2,%s,%s,b,,0,0,0,,{\pos(%s,%s)\p1}m 0 0 l %d 0 %d %d 0 %d' %
+				           ((config.time(chat.vstart), config.time(chat.vend)) +
+				            center + (width, width, height, height)))
+				width = round((config.width - 2) * config.scale)
+				height = round((YUGI_HEIGHT - 2 * YUGI_OUTLINE) * config.scale)
+				sink.event(r'Dialogue: 2,%s,%s,m,,0,0,0,,{\pos(%s,%s)\p1}m 0 0 l %d 0 %d %d 0 %d' %
+				           ((config.time(chat.vstart), config.time(chat.vend)) +
+				            center + (width, width, height, height)))
+			scale = min(config.width / chat.width, YUGI_HEIGHT / chat.height,
+			            1) - Fraction('0.01')
+			override = r'\pos(%s,%s)' % (config.x((config.width -
+			                                        chat.width * scale) / 2),
+			                              config.y(Fraction(YUGI_HEIGHT, 2)))
 			if scale != Fraction('0.99'):
 				override += r'\fscx{0}\fscy{0}'.format(number(scale * 100))
-			text = tidy_ass('{%s}%s' % (override, chat.text), 'MS PGothic')
+			text = tidy_ass('{%s}%s' % (override, chat.text), 'MS PGothic',
+			                chars)
 			chars['MS PGothic'].update(text.replace(r'\N', '').replace(r'\h', '\xa0'))
-			print(r'Dialogue: 2,%s,%s,y,,0,0,0,,%s' %
-			      (time(chat.vstart), time(chat.vend), text))
+			if cache is None or cache.want(chat.bounds_key):
+				sink.event(r'Dialogue: 2,%s,%s,y,,0,0,0,,%s' %
+				           (config.time(chat.vstart), config.time(chat.vend), text))
 		if chat.command == 'vote':
 			if chat.mode != 'stop':
-				if PASS <= 1:
-					chat.vote_vend = 10
+				if config.pass_number <= 1:
+					chat.vote_vend = config.seconds(10)
+				labels = percentages(chat)
 				for i, answer in enumerate(chat.answers):
-					box = answer_box(i, len(chat.answers))
+					geometry = answer_geometry(i, len(chat.answers), config)
+					box = geometry.box
 					text = '%d:%s' % (i + 1, answer)
-					thickness = max(box.width * Fraction('0.015'), 2)
-					radius = box.width * Fraction('0.15') / 2
-					outer = rounded_box(box.width, box.height,
-					                    radius + thickness / 2)
-					middle = rounded_box(box.width - thickness,
-					                     box.height - thickness,
-					                     radius)
-					inner = rounded_box(box.width - thickness * 2,
-					                    box.height - thickness * 2,
-					                    radius - thickness / 2)
-					outline = outer ^ (inner + (thickness, thickness))
-					middle *= 13
-					outline *= 13
-					print(r'Dialogue: 1,%s,%s,r,,0,0,0,,{\pos(%s,%s)\p%d}%s' %
-					      (time(chat.vstart), time(chat.vote_vend),
-					       number(box.center.x * 13),
-					       number(box.center.y * 13),
-					       middle.p, middle))
-					print(r'Dialogue: 1,%s,%s,l,,0,0,0,,{\pos(%s,%s)\p%d}%s' %
-					      (time(chat.vstart), time(chat.vote_vend),
-					       number(box.center.x * 13),
-					       number(box.center.y * 13),
-					       outline.p, outline))
+					if cache is None:
+						sink.event(r'Dialogue: 1,%s,%s,r,,0,0,0,,{\pos(%s)\p%d}%s' %
+						           (config.time(chat.vstart), config.time(chat.vote_vend),
+						            geometry.center, geometry.middle_p,
+						            geometry.middle))
+						sink.event(r'Dialogue: 1,%s,%s,l,,0,0,0,,{\pos(%s)\p%d}%s' %
+						           (config.time(chat.vstart), config.time(chat.vote_vend),
+						            geometry.center, geometry.outline_p,
+						            geometry.outline))
 					y, percentage = box.center.y, None
-					if (chat.mode == 'showresult' and
-					    chat.result_mode in {'percent', 'per'}):
-						total = sum(chat.results)
-						if total:
-							percentage = '%.1f%%' % round(chat.results[i] * 100 / total, 1)
-							y -= Fraction(chat.percentage_sizes[i][1], 2)
+					if labels is not None:
+						percentage = labels[i]
+						y -= Fraction(chat.percentage_sizes[i][1], 2)
 					# TODO: line wrapping
 					#scale = min((box.width - QUESTION_HORIZONTAL_PADDING * 2) / chat.answer_sizes[i][0], 1)
 					#override = r'\fscx{0}\fscy{0}'.format(number(scale * 100))
 					override = ''
-					if PASS == 2:
+					if config.pass_number == 2:
 						box_width = box.width - QUESTION_HORIZONTAL_PADDING * 2
 						text_width = min(chat.answer_sizes[i][0], box_width)
 						columns = 3 - (len(chat.answers) in {2, 4})
@@ -1206,223 +2803,898 @@ for chat in chats:
 						        (QUESTION_MAX_SIZE - QUESTION_MIN_SIZE) *
 						        min((box_width - text_width) * 2 / box_width,
 						            1)) * Fraction(2, columns)
-						if size != QUESTION_SIZE:
-							override = r'\fs%s' % number(size * 13)
+						if size != config.question_size:
+							override = r'\fs%s' % number(size * config.scale)
 					text = tidy_ass(r'{\pos(%s,%s)%s}%s' %
-					                (number(box.center.x * 13), number(y * 13),
-					                 override, text), 'MS PGothic')
+					                (config.x(box.center.x), config.y(y),
+					                 override, text), 'MS PGothic', chars)
 					chars['MS PGothic'].update(text.replace(r'\N', '').replace(r'\h', '\xa0'))
-					print('Dialogue: 1,%s,%s,v,,0,0,0,,%s' %
-					      (time(chat.vstart), time(chat.vote_vend), text))
+					if cache is None or cache.want(chat.answer_keys[i]):
+						sink.event('Dialogue: 1,%s,%s,v,,0,0,0,,%s' %
+						           (config.time(chat.vstart), config.time(chat.vote_vend), text))
 					if percentage is not None:
 						override = ''
-						if PASS == 2:
+						if config.pass_number == 2:
 							scale = box.width / chat.percentage_sizes[i][0]
 							if scale < 1:
 								override = r'\fscx{0}\fscy{0}'
 								override = override.format(number(scale * 100))
 						chars['MS PGothic'].update(percentage.replace(r'\N', '').replace(r'\h', '\xa0'))
-						print(r'Dialogue: 1,%s,%s,p,,0,0,0,,{\pos(%s,%s)%s}%s' %
-						      (time(chat.vstart), time(chat.vote_vend),
-						       number(box.center.x * 13),
-						       number((box.bottom - 6) * 13),
-						       override, percentage))
-		continue
+						if cache is None or cache.want(chat.percentage_keys[i]):
+							sink.event(r'Dialogue: 1,%s,%s,p,,0,0,0,,{\pos(%s,%s)%s}%s' %
+							           (config.time(chat.vstart), config.time(chat.vote_vend),
+							            config.x(box.center.x),
+							            config.y(box.bottom - 6),
+							            override, percentage))
+		return
 	
 	if chat.command is not None:
-		continue
+		return
 	
+	runs = font_runs(chat.text, chat.size)
+	for font_name, font_chars in runs.chars:
+		chars[font_name].update(font_chars)
+		if font_name != 'Arial':
+			counters['font fallbacks to ' + font_name] += 1
+	if config.pass_number == 0:
+		return
+	colors = ''
+	if chat.color != COLOR:
+		colors += r'\c%s' % color(chat.color)
+	if chat.border_color != BORDER_COLOR:
+		colors += r'\3c%s' % color(chat.border_color)
+	if chat.alpha * 510 < 509:
+		colors += r'\1a%s' % alpha(chat.alpha)
+	if alpha(chat.alpha * BORDER_ALPHA) != alpha(BORDER_ALPHA):
+		colors += r'\3a%s' % alpha(chat.alpha * BORDER_ALPHA)
 	overrides = []
 	
-	chat.height = LINE_HEIGHT[chat.size]
-	if chat.valign == 'bottom':
-		chat.y = HEIGHT - chat.height
-	else:
-		chat.y = 0
-	if PASS == 2:
-		overflow = False
-		changed = True
-		previous_chats = set()
-		for vpos in range(math.floor(chat.vstart), math.ceil(chat.vend)):
-			previous_chats |= tree[vpos]
-		while changed:
-			changed = False
-			for previous_chat in previous_chats:
-				if (chat.valign == 'normal') != (previous_chat.valign == 'normal'):
-					continue
-				if not (chat.y + chat.height > previous_chat.y and
-				        previous_chat.y + previous_chat.height > chat.y):
-					continue
-				vstart = max(chat.vstart, previous_chat.vstart)
-				vend = min(chat.vend, previous_chat.vend)
-				if vstart >= vend:
-					continue
-				xstart = chat.x(vstart)
-				xend = chat.x(vend)
-				previous_xstart = previous_chat.x(vstart)
-				previous_xend = previous_chat.x(vend)
-				if not ((xstart + chat.width > previous_xstart and
-				         previous_xstart + previous_chat.width > xstart) or
-				        (xend + chat.width > previous_xend and
-				         previous_xend + previous_chat.width > xend)):
-					continue
-				if chat.valign == 'bottom':
-					chat.y = previous_chat.y - chat.height - 1
-				else:
-					chat.y = previous_chat.y + previous_chat.height + 1
-				if chat.y + chat.height > HEIGHT:
-					overflow = True
-					break
-				changed = True
-				break
-		if overflow:
-			chat.alpha = DANMAKU_ALPHA
-			chat.y = chat.random_y()
-		tree.add(chat)
-	
-	font = None
-	size = None
-	text = []
-	braces = problematic_braces = False
-	ascender = 0
-	for match in re.finditer(r'(?s)\\\{|.', chat.text):
-		c = match.group()
-		if c == r'\{':
-			font_name = 'Arial'
-			chars[font_name].add('{')
-		# Variation Selectors block
-		elif 0xFE00 <= ord(c) <= 0xFE0F:
-			if font is None:
-				if 'lone' not in unsupported:
-					print('This file contains lone characters without '
-					      'glyphs. Arial will be used at your peril.',
-					      file=sys.stderr)
-					# Not sure things like the ascender calculation
-					# will be correct either...
-					unsupported.add('lone')
-				font_name = 'Arial'
-		elif c == '\u263A':  # WHITE SMILING FACE
-			if font is not None and font_name == 'MS PGothic':
-				# WTF, Windows
-				pass
-			else:
-				font_name = 'Arial'
-			chars[font_name].add(c)
-		else:
-			for font_name, (style, extra_font, sizes) in FONTS.items():
-				if extra_font.get_char_index(c):
-					chars[font_name].add(c)
-					break
-			else:
-				if 'fonts' not in unsupported:
-					print('This file contains characters not in any '
-					      'known font. Arial will be used at your peril.',
-					      file=sys.stderr)
-					unsupported.add('fonts')
-				font_name = 'Arial'
-		style, extra_font, sizes = FONTS[font_name]
-		if font is not extra_font:
-			if style is not None:
-				override = r'\r' + style
-				size = sizes[SIZE]['fs']
-				if chat.color != COLOR:
-					override += r'\c%s' % color(chat.color)
-				if chat.border_color != BORDER_COLOR:
-					override += r'\3c%s' % color(chat.border_color)
-				if chat.alpha * 510 < 509:
-					override += r'\1a%s' % alpha(chat.alpha)
-				if alpha(chat.alpha * BORDER_ALPHA) != alpha(BORDER_ALPHA):
-					override += r'\3a%s' % alpha(chat.alpha * BORDER_ALPHA)
-			else:
-				override = ''
-				if font is None:
-					if chat.color != COLOR:
-						override += r'\c%s' % color(chat.color)
-					if chat.border_color != BORDER_COLOR:
-						override += r'\3c%s' % color(chat.border_color)
-					if chat.alpha * 510 < 509:
-						override += r'\1a%s' % alpha(chat.alpha)
-					if alpha(chat.alpha * BORDER_ALPHA) != alpha(BORDER_ALPHA):
-						override += r'\3a%s' % alpha(chat.alpha * BORDER_ALPHA)
-				override += r'\fn' + font_name
-			if sizes[chat.size]['fs'] != size:
-				override += r'\fs%s' % number(sizes[chat.size]['fs'] * 13)
-			size = sizes[chat.size]['fs']
-			if text and text[-1] == '\\':
-				text.append('\u200b')
-			text.append('{%s}' % override)
-			problematic_braces |= braces
-			font = extra_font
-		elif c == '}':
-			problematic_braces |= braces
-		if c == r'\{':
-			braces = True
-		text.append(c)
-		ascender = max(ascender, sizes[chat.size]['asc'])
-	if problematic_braces:
-		if 'braces' not in unsupported:
-			print('This file contains "{" in comments before font changes '
-			      'or before "}". They will appear as "\\" in VSFilter.',
-			      file=sys.stderr)
-			unsupported.add('braces')
-		chars['Arial'].add('\\')
-	if PASS == 0:
-		continue
-	for i in range(len(text) - 1, -1, -1):
-		if text[i].endswith('}'):
-			break
-		elif text[i] == r'\{':
-			text[i] = '{'
-	
 	# Place the baseline where it should be
-	y = chat.y + ASCENDER[chat.size] - ascender
+	y = chat.y + ASCENDER[chat.size] - runs.ascender
 	if chat.valign == 'normal':
 		# VSFilter places the event at trunc(pos)-ceil(width/2),
 		# where all rounding is done to the nearest 1/8 layout pixel.
 		# For the left-hand position, this works out to 0 as is; perfect!
 		# For the right-hand position, we need to ceil the position
-		# we give it to ensure the result is not below WIDTH.
+		# we give it to ensure the result is not below config.width.
 		# As for non-VSFilter, this should at least do no harm.
 		overrides.append(r'\move(%s,%s,%s,%s)' %
-		                 (number((WIDTH + Fraction(math.ceil(chat.width * 4), 8)) * 13),
-		                  number(y * 13),
-		                  number(-chat.width * 13 / 2),
-		                  number(y * 13)))
+		                 (config.x(config.width + Fraction(math.ceil(chat.width * 4), 8)),
+		                  config.y(y),
+		                  config.x(-chat.width / 2),
+		                  config.y(y)))
 	else:
 		overrides.append(r'\pos(%s,%s)' %
-		                 (number(WIDTH * 13 / 2), number(y * 13)))
+		                 (config.x(Fraction(config.width, 2)), config.y(y)))
 	
-	savings = {'a': 0, 'g': 0}
-	for term in text:
-		if term.startswith(r'{\r'):
-			savings[term[3]] += 1
-	if text[0].startswith(r'{\r'):
-		savings[text[0][3]] += 2
-	style = max(savings, key=savings.__getitem__)
-	for i in range(len(text)):
-		if text[i].startswith(r'{\r' + style):
-			text[i] = r'{\r' + text[i][4:]
-	if re.match(r'^\{\\r(?![ag])', text[0]):
-		text[0] = '{' + text[0][3:]
-	overrides.append(text[0][1:-1])
+	def tag(run):
+		head, colored, tail, fs = run
+		if fs is not None:
+			tail += r'\fs%s' % number(fs * config.scale)
+		return head + colors * colored + tail
+	overrides.append(tag(runs.first))
 	
-	text = ''.join(text[1:])
+	text = ''.join([run if isinstance(run, str) else '{%s}' % tag(run)
+	                for run in runs.runs])
+	style = runs.style
 	overrides = ''.join(overrides)
 	if overrides:
 		overrides = '{%s}' % overrides
-	if PASS == 1:
-		chat.vstart, chat.vend = 0, 10
-	print('Dialogue: 0,%s,%s,%s,%s,0,0,0,,%s%s' %
-	      (time(chat.vstart), time(chat.vend),
-	       style, chat.user_id, overrides, text))
+	if config.pass_number == 1:
+		chat.vstart, chat.vend = config.seconds(0), config.seconds(10)
+	if cache is None or cache.want(chat.bounds_key):
+		sink.event('Dialogue: 0,%s,%s,%s,%s,0,0,0,,%s%s' %
+		           (config.time(chat.vstart), config.time(chat.vend),
+		            style, chat.user_id, overrides, text))
+
+def convert(file, output=None, config=None, bounds='bounds.txt',
+            measurement='bounds', bounds_cache='bounds-cache.txt',
+            profile=None, layout_jobs=None, renditions=(), layout=None):
+	"""convert(file, output=None, config=None, bounds='bounds.txt', measurement='bounds', bounds_cache='bounds-cache.txt', profile=None, layout_jobs=None, renditions=(), layout=None) -> dict
+
+Convert one NicoNico comment XML file (a path or a file object) to ASS,
+writing the script to output, a Sink or anything Sink() accepts (a
+SortedSink is closed once the script is rendered). config is a Config,
+by default Config(). The characters used from each font are
+returned for PASS 0.
+
+If measurement is 'bounds', PASS 1 outputs only the texts that are not in
+bounds_cache yet, and saves their cache keys next to the bounds file
+(with the extension .keys). Once that output is rendered to the bounds
+file, PASS 2 adds the sizes to the cache and looks up every text there.
+If measurement is 'freetype', PASS 2 computes the sizes from the fonts.
+
+If profile is a dict, the wall time and peak memory of each stage and the
+hot path counters are stored in it (under 'stages' and 'counters').
+
+If layout_jobs is not None, danmaku are laid out in that many processes
+(see lay_out_sharded()).
+
+renditions lists more scripts to write in PASS 2, as (output, scale,
+aspect) for the Config settings of the same names. They are rendered
+from the same measured and laid out chats as the main script.
+
+If layout is not None, the laid out chats are also saved to that path
+in PASS 2 (see save_layout())."""
+	if config is None:
+		config = Config()
+	if renditions and config.pass_number != 2:
+		raise ValueError('renditions need PASS 2')
+	if layout is not None and config.pass_number != 2:
+		raise ValueError('saving the layout needs PASS 2')
+	unsupported.clear()
+	unsupported_commands.clear()
+	counters.clear()
+	if profile is not None:
+		tracemalloc = _import('tracemalloc')
+		profile['stages'] = OrderedDict()
+	def stage(name, function, *args):
+		if profile is None:
+			return function(*args)
+		# The peak is of the memory allocated during the stage
+		tracemalloc.start()
+		start = timeit.default_timer()
+		try:
+			return function(*args)
+		finally:
+			profile['stages'][name] = {
+				'seconds': timeit.default_timer() - start,
+				'peak_bytes': tracemalloc.get_traced_memory()[1],
+			}
+			tracemalloc.stop()
+
+	chats = stage('load', load_chats, file, config)
+	stage('resolve_timing', resolve_timing, chats)
+	stage('decimate', decimate, chats, config)
+	cache = stage('measure', measure_sizes, chats, config, measurement, bounds,
+	              bounds_cache)
+	stage('lay_out', lay_out, chats, config, layout_jobs)
+	if layout is not None:
+		stage('save_layout', save_layout, chats, config, layout)
+
+	chars = _render_outputs(chats, config, output, renditions, cache, stage)
+	if config.pass_number == 1 and cache is not None:
+		cache.save_wanted(os.path.splitext(bounds)[0] + '.keys')
+	if profile is not None:
+		profile['counters'] = OrderedDict(sorted(counters.items()))
+
+	if unsupported_commands:
+		print('Unhandled commands:', ', '.join(unsupported_commands),
+		      file=sys.stderr)
+
+	return chars
+
+def _render_outputs(chats, config, output, renditions, cache, stage):
+	# Render the main script to output and each of the renditions,
+	# timing each with stage(), and return the characters used
+	outputs = [(output, config)]
+	outputs += [(rendition_output, config.replace(scale=scale, aspect=aspect))
+	            for rendition_output, scale, aspect in renditions]
+	for n, (output, output_config) in enumerate(outputs):
+		sink = output if isinstance(output, Sink) else Sink(output)
+		events, written = sink.events, sink.bytes
+		rendered = stage('render %d' % n if n else 'render', render, chats,
+		                 output_config, sink, cache)
+		if not n:
+			chars = rendered
+		if sink is output and not isinstance(sink, SortedSink):
+			sink.flush()
+		else:
+			# A sorted script can be written out once it is all rendered
+			sink.close()
+		counters['events written'] += sink.events - events
+		counters['bytes written'] += sink.bytes - written
+	return chars
+
+# Increased whenever the contents of layout files change
+LAYOUT_VERSION = 2
+LAYOUT_FORMAT = 'niconico-to-ass layout'
+# The attributes of each chat that render_chat() needs, in layout files
+LAYOUT_FIELDS = ('command', 'text', 'vstart', 'vend', 'size', 'valign',
+                 'color', 'border_color', 'alpha', 'y', 'width', 'height',
+                 'user_id', 'bounds_key', '_extra')
+
+def save_layout(chats, config, path):
+	"""save_layout(chats, config, path)
 
-if unsupported_commands:
-	print('Unhandled commands:', ', '.join(unsupported_commands),
-	      file=sys.stderr)
+Save measured and laid out PASS 2 chats to a layout file at path
+(compressed with gzip if it ends with .gz), from which render_layout()
+can write the script again without reading, measuring or laying out
+the comments. For each chat that renders anything, it keeps what
+render_chat() needs: the timing, the position and size, the colors and
+alpha (which also tell whether it overflowed the screen), the text and
+any vote. The font runs (see font_runs()) of the danmaku texts, with
+their styles, are kept too, along with the settings and the warnings
+given so far.
+
+Layout files are JSON objects with the members format (LAYOUT_FORMAT),
+version (LAYOUT_VERSION), settings (the Config settings by name),
+warnings and commands (the keys of unsupported and unsupported_commands),
+fields (LAYOUT_FIELDS), font_runs (a [text, size, runs] list for each
+text) and chats (a list of values in the order of fields for each chat).
+Values that JSON has no type for are objects with a single member:
+{"$fraction": [numerator, denominator]}, {"$tuple": [...]} and
+{"$set": [...]}."""
+	assert config.pass_number == 2, 'layouts are only saved in PASS 2'
+	records = []
+	runs = {}
+	for chat in chats:
+		if chat.command not in {None, 'perm', 'vote'}:
+			continue
+		if chat.command is None:
+			key = chat.text, chat.size
+			if key not in runs:
+				runs[key] = [chat.text, chat.size,
+				             _layout_value(tuple(font_runs(chat.text,
+				                                           chat.size)))]
+		records.append([_layout_value(getattr(chat, name, None))
+		                for name in LAYOUT_FIELDS])
+	layout = OrderedDict((
+		('format', LAYOUT_FORMAT),
+		('version', LAYOUT_VERSION),
+		('settings', OrderedDict((name, _layout_value(getattr(config, name)))
+		                         for name in config._SETTINGS)),
+		('warnings', sorted(unsupported)),
+		('commands', sorted(unsupported_commands)),
+		('fields', LAYOUT_FIELDS),
+		('font_runs', list(runs.values())),
+		('chats', records),
+	))
+	opener = _import('gzip').open if path.endswith('.gz') else open
+	with opener(path, 'wt', encoding='utf-8') as file:
+		_import('json').dump(layout, file, ensure_ascii=False,
+		                     separators=(',', ':'))
+		file.write('\n')
 
-if PASS == 0:
+def _layout_value(value):
+	# Turn a value into what JSON can store (see save_layout())
+	if isinstance(value, Fraction):
+		return {'$fraction': [value.numerator, value.denominator]}
+	elif isinstance(value, tuple):
+		return {'$tuple': [_layout_value(item) for item in value]}
+	elif isinstance(value, (set, frozenset)):
+		return {'$set': sorted(value)}
+	elif isinstance(value, list):
+		return [_layout_value(item) for item in value]
+	elif isinstance(value, dict):
+		return OrderedDict((key, _layout_value(item))
+		                   for key, item in value.items())
+	assert value is None or isinstance(value, (bool, int, str)), \
+		'%r cannot be saved in a layout' % (value,)
+	return value
+
+def _layout_object(members):
+	# Turn a JSON object from a layout file back into its value
+	# (see save_layout())
+	if len(members) == 1:
+		(key, value), = members
+		if key == '$fraction':
+			if not (isinstance(value, list) and len(value) == 2 and
+			        all(type(number) is int for number in value) and
+			        value[1] > 0):
+				raise ValueError('bad fraction %r' % (value,))
+			return Fraction(*value)
+		elif key == '$tuple':
+			if not isinstance(value, list):
+				raise ValueError('bad tuple %r' % (value,))
+			return tuple(value)
+		elif key == '$set':
+			if not (isinstance(value, list) and
+			        all(isinstance(item, str) for item in value)):
+				raise ValueError('bad set %r' % (value,))
+			return frozenset(value)
+	for key, value in members:
+		if key.startswith('$'):
+			raise ValueError('unknown value type %r' % key)
+	return OrderedDict(members)
+
+def load_layout(path):
+	"""load_layout(path) -> (list of Chat, Config)
+
+Read a layout file saved by save_layout(), raising ValueError if it is
+not a valid one of this version. Its font runs are put in the font runs
+cache of its fonts (see use_fonts()), so that rendering the chats does not
+need to split them again."""
+	opener = _import('gzip').open if path.endswith('.gz') else open
+	try:
+		with opener(path, 'rt', encoding='utf-8') as file:
+			layout = _import('json').load(file,
+			                              object_pairs_hook=_layout_object)
+		if not isinstance(layout, dict) or layout.get('format') != LAYOUT_FORMAT:
+			raise ValueError('not a layout file')
+		if layout.get('version') != LAYOUT_VERSION:
+			raise ValueError('version %r instead of %d'
+			                 % (layout.get('version'), LAYOUT_VERSION))
+		chats, config, runs = _check_layout(layout)
+	except (OSError, EOFError, UnicodeDecodeError, ValueError) as e:
+		# JSON errors are ValueErrors too
+		raise ValueError('%s is not a valid layout file: %s' % (path, e))
+	for key in layout['warnings']:
+		# Only the keys with a message in WARNINGS are given again
+		if key in WARNINGS:
+			warn(key)
+		else:
+			unsupported.add(key)
+	unsupported_commands.update(layout['commands'])
+	use_fonts(config)
+	_font_runs_cache.update(runs)
+	return chats, config
+
+def _check_layout(layout):
+	# Validate the contents of a layout file and return its chats,
+	# its Config and its font runs by (text, size)
+	def check(condition, message):
+		if not condition:
+			raise ValueError(message)
+	def strings(value):
+		return isinstance(value, list) and all(isinstance(item, str)
+		                                       for item in value)
+	expected = {'format', 'version', 'settings', 'warnings', 'commands',
+	            'fields', 'font_runs', 'chats'}
+	check(set(layout) == expected, 'unexpected members')
+	settings = layout['settings']
+	check(isinstance(settings, dict) and set(settings) <= set(Config._SETTINGS),
+	      'bad settings')
+	check(strings(layout['warnings']) and strings(layout['commands']),
+	      'bad warnings')
+	fields = layout['fields']
+	check(strings(fields) and set(fields) <= set(LAYOUT_FIELDS),
+	      'bad fields')
+	try:
+		config = Config(**settings)
+	except (AssertionError, TypeError, ValueError) as e:
+		raise ValueError('bad settings: %s' % e)
+
+	runs = {}
+	check(isinstance(layout['font_runs'], list), 'bad font runs')
+	for entry in layout['font_runs']:
+		check(isinstance(entry, list) and len(entry) == 3 and
+		      isinstance(entry[0], str) and entry[1] in LINE_HEIGHT and
+		      isinstance(entry[2], tuple) and
+		      len(entry[2]) == len(FontRuns._fields),
+		      'bad font runs')
+		text, size, values = entry
+		first, run_list, ascender, style, chars, warnings = values
+		check(isinstance(first, tuple) and isinstance(run_list, list) and
+		      all(isinstance(run, (str, tuple)) for run in run_list) and
+		      isinstance(chars, tuple) and
+		      all(isinstance(item, tuple) and len(item) == 2 and
+		          item[0] in config.font_files for item in chars) and
+		      isinstance(warnings, tuple) and
+		      all(warning in WARNINGS for warning in warnings),
+		      'bad font runs')
+		runs[text, size] = FontRuns(first, run_list, ascender, style, chars,
+		                            warnings)
+
+	chats = []
+	check(isinstance(layout['chats'], list), 'bad chats')
+	for record in layout['chats']:
+		check(isinstance(record, list) and len(record) == len(fields),
+		      'bad chat')
+		chat = Chat.__new__(Chat)
+		for name, value in zip(fields, record):
+			if name == '_extra' and value is not None:
+				# Only the vote attributes live there
+				check(isinstance(value, dict) and
+				      all(isinstance(getattr(Chat, key, None), property)
+				          for key in value), 'bad chat')
+				value = dict(value)
+			setattr(chat, name, value)
+		chats.append(chat)
+	return chats, config, runs
+
+def render_layout(path, output=None, config=None, renditions=()):
+	"""render_layout(path, output=None, config=None, renditions=()) -> dict
+
+Write the ASS script for a layout file saved by save_layout() to output,
+as convert() would have. Only the scale and aspect of config are used;
+all other settings come from the layout file. renditions are as for
+convert(). The characters used from each font are returned."""
+	unsupported.clear()
+	unsupported_commands.clear()
+	counters.clear()
+	chats, layout_config = load_layout(path)
+	if config is not None:
+		layout_config = layout_config.replace(scale=config.scale,
+		                                      aspect=config.aspect)
+	chars = _render_outputs(chats, layout_config, output, renditions, None,
+	                        lambda name, function, *args: function(*args))
+	if unsupported_commands:
+		print('Unhandled commands:', ', '.join(unsupported_commands),
+		      file=sys.stderr)
+	return chars
+
+def verify_time_base(file, output=None, config=None, **options):
+	"""verify_time_base(file, output=None, config=None, **options) -> dict
+
+Convert file with config, by default Config(time_base='microseconds'),
+and again with exact Fractions, and warn if the two scripts differ.
+The exact script is written to output and the result of convert()
+is returned."""
+	if config is None:
+		config = Config(time_base='microseconds')
+	if not isinstance(file, str):
+		file = io.StringIO(file.read())
+	state = random.getstate()
+	fast = io.StringIO()
+	# Its warnings will be repeated by the exact conversion
+	with _import('contextlib').redirect_stderr(io.StringIO()):
+		convert(file, fast, config, **options)
+	if not isinstance(file, str):
+		file.seek(0)
+	random.setstate(state)
+	exact = io.StringIO()
+	exact_sink = Sink(exact)
+	chars = convert(file, exact_sink, config.replace(time_base='fraction'),
+	                **options)
+	fast_lines = fast.getvalue().splitlines()
+	exact_lines = exact.getvalue().splitlines()
+	differences = [(i, fast_line, exact_line) for i, (fast_line, exact_line)
+	               in enumerate(itertools.zip_longest(fast_lines, exact_lines,
+	                                                  fillvalue=''))
+	               if fast_line != exact_line]
+	if differences:
+		i, fast_line, exact_line = differences[0]
+		print('The %s time base changes %d lines of output. The first is '
+		      'line %d:\n-%s\n+%s' % (config.time_base, len(differences),
+		                              i + 1, exact_line, fast_line),
+		      file=sys.stderr)
+		unsupported.add('time_base')
+	sink = output if isinstance(output, Sink) else Sink(output)
+	sink.write(exact.getvalue())
+	sink.events += exact_sink.events
+	if sink is output:
+		sink.flush()
+	else:
+		sink.close()
+	return chars
+
+def follow(file, output=None, config=None, window=2, segment=10, poll=0.5):
+	"""follow(file, output=None, config=None, window=2, segment=10, poll=0.5)
+
+Convert a live comment stream while it is still being written, writing the
+events of each chat to output (a Sink or anything Sink() accepts) soon
+after it arrives. file is a binary file object or a path, which is read
+through its end and then checked for more every poll seconds until its
+packet is closed; it can also be '-' for stdin, 'tcp:HOST:PORT' or
+'unix:PATH' for a socket, which are read until they close (see
+read_stream() for the formats). Reading can also be stopped with
+KeyboardInterrupt, after which everything read is still written out.
+
+Instead of sorting all chats, they are put in order within a window:
+a chat is laid out once one window seconds later has arrived, against the
+chats still on screen. Ones that come later than that are laid out late.
+/perm and /vote events are written in segments of up to segment seconds
+(see LiveTiming). Sizes are computed from the fonts, so config must be
+for PASS 2. Random heights come from chat_random(config.seed, n) for the
+n-th chat read."""
+	if config is None:
+		config = Config()
+	if config.pass_number != 2:
+		sys.exit('Following a comment stream needs PASS 2.')
+	unsupported.clear()
+	unsupported_commands.clear()
+	counters.clear()
+	heapq = _import('heapq')
+	opened = None
+	if file == '-':
+		file = sys.stdin.buffer
+		poll = None
+	elif isinstance(file, str) and file.startswith(('tcp:', 'unix:')):
+		socket = _import('socket')
+		kind, address = file.split(':', 1)
+		if kind == 'tcp':
+			host, port = address.rsplit(':', 1)
+			connection = socket.create_connection((host, int(port)))
+		else:
+			connection = socket.socket(socket.AF_UNIX)
+			connection.connect(address)
+		# The file keeps the connection open until it is closed itself
+		file = opened = connection.makefile('rb')
+		connection.close()
+		poll = None
+	elif isinstance(file, str):
+		file = opened = open(file, 'rb')
+
+	sink = output if isinstance(output, Sink) else Sink(output)
+	render_header(config, sink)
+	sink.flush()
+	chars = {name: set() for name in FONTS}
+	layout = ActiveLayout(config)
+	timing = LiveTiming(config, sink, config.seconds(segment))
+	window = config.seconds(window)
+	pending = []
+	latest = released = None
+	def release(n, chat):
+		nonlocal released
+		if released is not None and chat.vstart < released:
+			counters['late chats'] += 1
+		released = chat.vstart if released is None else max(released, chat.vstart)
+		if chat.command is None:
+			measure_chats([chat])
+			position(chat, config)
+			layout.place(chat, chat_random(config.seed, n))
+			render_chat(chat, config, sink, chars)
+		else:
+			timing.add(chat, chars)
+		timing.advance(chat.vstart)
+	try:
+		try:
+			for n, chat in enumerate(read_stream(file, config, poll)):
+				if timing.max_vend is None or chat.vend > timing.max_vend:
+					timing.max_vend = chat.vend
+				if latest is None or chat.vstart > latest:
+					latest = chat.vstart
+				heapq.heappush(pending, (chat.vstart, n, chat))
+				events = sink.events
+				while pending and pending[0][0] <= latest - window:
+					release(*heapq.heappop(pending)[1:])
+				if sink.events != events:
+					sink.flush()
+		except KeyboardInterrupt:
+			pass
+		except (AssertionError, ElementTree.ParseError) as e:
+			sys.exit('This is not a valid NicoNico comment stream: ' + str(e))
+		while pending:
+			release(*heapq.heappop(pending)[1:])
+		timing.finish()
+	finally:
+		if opened is not None:
+			opened.close()
+		if sink is output:
+			sink.flush()
+		else:
+			sink.close()
+
+	if unsupported_commands:
+		print('Unhandled commands:', ', '.join(unsupported_commands),
+		      file=sys.stderr)
+
+def save_chars(chars):
 	for font_name, font_chars in chars.items():
 		with open(os.path.join('chars', font_name), encoding='utf-8') as file:
 			font_chars.update(file.read())
 		with open(os.path.join('chars', font_name), 'w', encoding='utf-8') as file:
-			file.write(''.join(font_chars))
\ No newline at end of file
+			file.write(''.join(font_chars))
+
+
+def _init_worker(config):
+	use_fonts(config)
+
+def _convert_job(job):
+	input, output, options = job
+	result = {'input': input, 'output': output}
+	chars = None
+	options = dict(options)
+	run = verify_time_base if options.pop('verify', False) else convert
+	if options.pop('profile', False):
+		options['profile'] = result['profile'] = {}
+	start = timeit.default_timer()
+	try:
+		with Sink(output) as sink:
+			chars = run(input, sink,
+			            bounds=os.path.splitext(input)[0] + '.bounds.txt',
+			            **options)
+		result['events'] = sink.events
+		result['bytes'] = sink.bytes
+	except (Exception, SystemExit) as e:
+		result['error'] = str(e)
+	result['seconds'] = timeit.default_timer() - start
+	result['warnings'] = sorted(unsupported)
+	result['commands'] = sorted(unsupported_commands)
+	return result, chars
+
+def convert_batch(inputs, output_dir=None, jobs=None, manifest=None,
+                  compress=False, config=None, **options):
+	"""convert_batch(inputs, output_dir=None, jobs=None, manifest=None, compress=False, config=None, **options) -> list
+
+Convert many comment XML files in a pool of worker processes, each of
+which opens the fonts only once. Every input gets an .ass file (.ass.gz if
+compress is true) next to it (or in output_dir), and a JSON manifest with
+per-file timings, sizes, warnings and errors is written to manifest (by
+default, manifest.json in output_dir or the current directory).
+The manifest entries are returned.
+Other keyword arguments are passed on to convert(), except that a true
+profile makes every manifest entry include that conversion's profile."""
+	if config is None:
+		config = Config()
+	options['config'] = config
+	work = []
+	for input in inputs:
+		name = os.path.splitext(os.path.basename(input))[0] + '.ass'
+		if compress:
+			name += '.gz'
+		directory = os.path.dirname(input) if output_dir is None else output_dir
+		work.append((input, os.path.join(directory, name), options))
+	if output_dir is not None:
+		os.makedirs(output_dir, exist_ok=True)
+	results = []
+	all_chars = {}
+	pool = _import('multiprocessing').Pool(jobs, _init_worker, (config,))
+	try:
+		for result, chars in pool.imap_unordered(_convert_job, work):
+			if 'error' in result:
+				print('%s: %s' % (result['input'], result['error']),
+				      file=sys.stderr)
+			results.append(result)
+			for font_name, font_chars in (chars or {}).items():
+				all_chars.setdefault(font_name, set()).update(font_chars)
+	finally:
+		pool.close()
+		pool.join()
+	results.sort(key=lambda result: result['input'])
+	if config.pass_number == 0:
+		save_chars(all_chars)
+	if manifest is None:
+		manifest = os.path.join(output_dir or os.curdir, 'manifest.json')
+	with open(manifest, 'w', encoding='utf-8') as file:
+		_import('json').dump(results, file, indent='\t', sort_keys=True)
+	return results
+
+def save_profile(profile, path):
+	with open(path, 'w', encoding='utf-8') as file:
+		_import('json').dump(profile, file, indent='\t')
+
+def print_startup_report(file=sys.stderr):
+	"""print_startup_report(file=sys.stderr)
+
+Print how long each import and font opening has taken so far."""
+	for name, seconds in startup_times.items():
+		print('%9.1f ms  %s' % (seconds * 1000, name), file=file)
+	print('%9.1f ms  total' % (sum(startup_times.values()) * 1000), file=file)
+
+def positive_fraction(text):
+	"""positive_fraction(text) -> Fraction
+
+Parse a positive number, such as a scale."""
+	number = Fraction(text)
+	if number <= 0:
+		raise ValueError('not positive')
+	return number
+
+def aspect_ratio(text):
+	"""aspect_ratio(text) -> Fraction
+
+Parse an aspect ratio given as W:H or as a number."""
+	width, colon, height = text.partition(':')
+	if colon:
+		return positive_fraction(width) / positive_fraction(height)
+	return positive_fraction(text)
+
+def rendition(text):
+	"""rendition(text) -> (str, Fraction, Fraction or None)
+
+Parse a rendition given as SCALE[,ASPECT]=FILE into a (output, scale,
+aspect) tuple for convert()."""
+	settings, equals, output = text.partition('=')
+	if not equals or not output:
+		raise ValueError('missing output file')
+	scale, comma, aspect = settings.partition(',')
+	return (output, positive_fraction(scale),
+	        aspect_ratio(aspect) if comma else None)
+
+def main():
+	argparse = _import('argparse')
+	parser = argparse.ArgumentParser()
+	parser.add_argument('file', nargs='+',
+	                    help='NicoNico comment XML file, or a directory of them; '
+	                         'more than one input selects batch mode')
+	parser.add_argument('-o', '--output-dir',
+	                    help='write one .ass file per input into this directory '
+	                         '(batch mode; default: next to each input)')
+	parser.add_argument('-j', '--jobs', type=int,
+	                    help='number of worker processes in batch mode '
+	                         '(default: number of CPUs)')
+	parser.add_argument('--output', metavar='FILE',
+	                    help='write the script to this file instead of stdout '
+	                         '(single input only; compressed if it ends in .gz)')
+	parser.add_argument('--gzip', action='store_true',
+	                    help='write compressed .ass.gz files in batch mode')
+	parser.add_argument('--manifest',
+	                    help='where to write the JSON manifest in batch mode '
+	                         '(default: manifest.json in the output directory)')
+	parser.add_argument('--measure', choices=('bounds', 'freetype'),
+	                    default='bounds',
+	                    help='in PASS 2, read text sizes from the bounds file '
+	                         'rendered from PASS 1 (default), or compute them '
+	                         'from the fonts right away')
+	parser.add_argument('--bounds-cache', default='bounds-cache.txt',
+	                    help='file that keeps the text sizes read from bounds '
+	                         'files across conversions (default: %(default)s)')
+	parser.add_argument('--time-base', choices=sorted(TIME_BASES),
+	                    default='fraction',
+	                    help='represent timestamps as exact fractions of a '
+	                         'second (default) or as integer microseconds, '
+	                         'which is faster')
+	parser.add_argument('--verify-time-base', action='store_true',
+	                    help='also convert with exact fractions, output that '
+	                         'and warn about any lines --time-base changed')
+	parser.add_argument('--profile', metavar='FILE',
+	                    help='write the time and peak memory of each stage '
+	                         'and the hot path counters to this JSON file '
+	                         '(in batch mode, a list with one entry per input)')
+	parser.add_argument('--layout-jobs', type=int, metavar='N',
+	                    help='lay out danmaku in N processes, one piece of '
+	                         'the timeline at a time (single input only); '
+	                         'implies --seed 0 unless given')
+	parser.add_argument('--seed', type=int,
+	                    help='make the random heights of danmaku that do not '
+	                         'fit on screen reproducible')
+	parser.add_argument('--follow', action='store_true',
+	                    help='convert a live comment stream as it comes: a '
+	                         'growing XML file, - for chat lines on stdin, or '
+	                         'tcp:HOST:PORT or unix:PATH for a socket '
+	                         '(PASS 2 only; sizes come from the fonts)')
+	parser.add_argument('--window', type=Fraction, default=2,
+	                    help='with --follow, how many seconds to wait for '
+	                         'chats that arrive out of order '
+	                         '(default: %(default)s)')
+	parser.add_argument('--segment', type=Fraction, default=10,
+	                    help='with --follow, how many seconds of a /perm or '
+	                         '/vote to write at a time (default: %(default)s)')
+	parser.add_argument('--poll', type=float, default=0.5,
+	                    help='with --follow, how often to check a file for '
+	                         'new chats, in seconds (default: %(default)s)')
+	parser.add_argument('--scale', type=positive_fraction, default=SCALE,
+	                    help='PlayRes pixels per layout pixel, which is %dx%d '
+	                         '(default: %%(default)s)' % (WIDTH, HEIGHT))
+	parser.add_argument('--aspect', type=aspect_ratio,
+	                    help='widen or heighten PlayRes to this aspect ratio, '
+	                         'such as 4:3, keeping the comments centered')
+	parser.add_argument('--rendition', type=rendition, action='append',
+	                    default=[], metavar='SCALE[,ASPECT]=FILE',
+	                    help='also write the script at another scale and '
+	                         'aspect ratio to FILE, from the same layout '
+	                         '(single input only, PASS 2 only; repeatable)')
+	parser.add_argument('--save-layout', metavar='FILE',
+	                    help='also save the laid out comments to FILE, '
+	                         'to render again later with --from-layout '
+	                         '(single input only, PASS 2 only)')
+	parser.add_argument('--from-layout', action='store_true',
+	                    help='the input is a file saved by --save-layout; '
+	                         'only render it, with the current styles')
+	parser.add_argument('--sort-events', action='store_true',
+	                    help='write events in order of start time, which '
+	                         'renderers load and seek through faster')
+	parser.add_argument('--split', type=positive_fraction, metavar='SECONDS',
+	                    help='split the script into files of this many '
+	                         'seconds, each with the header and the events '
+	                         'shown in it (implies --sort-events; needs '
+	                         '--output)')
+	parser.add_argument('--index', action='store_true',
+	                    help='write the time span of each file and the byte '
+	                         'offsets to seek to every %d seconds to '
+	                         'NAME.index.json next to the output (implies '
+	                         '--sort-events; needs --output)' % INDEX_STEP)
+	parser.add_argument('--max-danmaku', type=int, metavar='N',
+	                    help='show at most N scrolling, N top and N bottom '
+	                         'danmaku at a time, dropping deleted ones, those '
+	                         'with the lowest scores, then those by regular '
+	                         'users and small ones first (PASS 2 only)')
+	parser.add_argument('--startup-report', action='store_true',
+	                    help='print how long imports and opening fonts took '
+	                         '(see also python -X importtime)')
+	args = parser.parse_args()
+	time_base = args.time_base
+	if args.verify_time_base and time_base == 'fraction':
+		time_base = 'microseconds'
+	if args.max_danmaku is not None and args.max_danmaku < 1:
+		parser.error('--max-danmaku must be at least 1')
+	config = Config(time_base=time_base, seed=args.seed, scale=args.scale,
+	                aspect=args.aspect, max_danmaku=args.max_danmaku)
+	options = {'measurement': args.measure, 'bounds_cache': args.bounds_cache,
+	           'config': config}
+	if args.verify_time_base:
+		options['verify'] = True
+
+	sort_events = args.sort_events or args.split is not None or args.index
+	if (args.split is not None or args.index) and args.output is None:
+		parser.error('--split and --index need --output')
+	def sink(output):
+		if not sort_events:
+			return output
+		return SortedSink(output, args.split,
+		                  index_path(output) if args.index else None)
+
+	if args.follow:
+		if len(args.file) != 1 or args.output_dir is not None:
+			parser.error('--follow needs a single input')
+		if args.rendition:
+			parser.error('--rendition cannot be used with --follow')
+		if sort_events:
+			parser.error('--follow writes events as they come')
+		if args.max_danmaku is not None:
+			parser.error('--max-danmaku cannot be used with --follow')
+		follow(args.file[0], args.output, config, args.window, args.segment,
+		       args.poll)
+		if args.startup_report:
+			print_startup_report()
+		return
+
+	if args.from_layout:
+		if len(args.file) != 1 or args.output_dir is not None:
+			parser.error('--from-layout needs a single input')
+		if args.verify_time_base or args.save_layout is not None:
+			parser.error('--from-layout only renders')
+		sinks = [sink(args.output)]
+		sinks += [sink(output) for output, scale, aspect in args.rendition]
+		try:
+			render_layout(args.file[0], sinks[0], config,
+			              [(output,) + rendition[1:] for output, rendition
+			               in zip(sinks[1:], args.rendition)])
+		except ValueError as e:
+			sys.exit(str(e))
+		for output in sinks:
+			if isinstance(output, Sink):
+				output.close()
+		if args.startup_report:
+			print_startup_report()
+		return
+
+	if (len(args.file) == 1 and not os.path.isdir(args.file[0]) and
+	    args.output_dir is None):
+		try:
+			file = argparse.FileType('r')(args.file[0])
+		except argparse.ArgumentTypeError as e:
+			parser.error(str(e))
+		run = verify_time_base if options.pop('verify', False) else convert
+		if args.rendition or args.save_layout is not None:
+			if run is not convert:
+				parser.error('--rendition and --save-layout cannot be used '
+				             'with --verify-time-base')
+			if config.pass_number != 2:
+				parser.error('--rendition and --save-layout need PASS 2')
+			options['layout'] = args.save_layout
+		if sort_events and run is not convert:
+			parser.error('--verify-time-base writes events as they come')
+		sinks = [sink(args.output)]
+		sinks += [sink(output) for output, scale, aspect in args.rendition]
+		if args.rendition:
+			options['renditions'] = [(output,) + rendition[1:]
+			                         for output, rendition
+			                         in zip(sinks[1:], args.rendition)]
+		profile = None if args.profile is None else {'input': args.file[0]}
+		chars = run(file, sinks[0], profile=profile,
+		            layout_jobs=args.layout_jobs, **options)
+		for output in sinks:
+			if isinstance(output, Sink):
+				output.close()
+		if config.pass_number == 0:
+			save_chars(chars)
+		if profile is not None:
+			save_profile(profile, args.profile)
+		if args.startup_report:
+			print_startup_report()
+		return
+
+	inputs = []
+	for name in args.file:
+		if os.path.isdir(name):
+			inputs += sorted(os.path.join(name, entry)
+			                 for entry in os.listdir(name)
+			                 if entry.lower().endswith('.xml'))
+		else:
+			inputs.append(name)
+	if args.output is not None:
+		parser.error('--output needs a single input file; use --output-dir')
+	if args.layout_jobs is not None:
+		parser.error('--layout-jobs needs a single input file')
+	if args.rendition or args.save_layout is not None:
+		parser.error('--rendition and --save-layout need a single input file')
+	if sort_events:
+		parser.error('--sort-events, --split and --index need a single '
+		             'input file')
+	if args.profile is not None:
+		options['profile'] = True
+	results = convert_batch(inputs, args.output_dir, args.jobs, args.manifest,
+	                        args.gzip, **options)
+	if args.profile is not None:
+		save_profile([dict(result.get('profile', {}), input=result['input'])
+		              for result in results], args.profile)
+	if args.startup_report:
+		print_startup_report()
+	if any('error' in result for result in results):
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# Tests for niconico-to-ass.py that need neither fonts nor freetype
+#
+#     python3 -m unittest test_niconico_to_ass
+
+import contextlib, importlib.util, io, os, random, sys, tempfile, unittest
+from collections import OrderedDict, defaultdict
+
+def load_converter():
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+	                    'niconico-to-ass.py')
+	spec = importlib.util.spec_from_file_location('niconico_to_ass', path)
+	module = importlib.util.module_from_spec(spec)
+	# Worker processes find its functions and classes by module name
+	sys.modules[spec.name] = module
+	spec.loader.exec_module(module)
+	return module
+
+converter = load_converter()
+
+class FakeFace:
+	"""FakeFace(chars)
+
+Stands in for a freetype.Face that has glyphs for exactly chars."""
+	def __init__(self, chars):
+		self._chars = chars
+	def get_char_index(self, c):
+		return int(c in self._chars)
+
+class FakeGlyphMetrics(dict):
+	"""Stands in for the glyph metrics cache of FakeFaces, which would need
+freetype to fill: every glyph is fs pixels wide, and a missing glyph
+(the box that the font draws instead) half that."""
+	def __missing__(self, key):
+		font_name, fs, c = key
+		face = converter.FONTS[font_name][1]
+		advance = fs * 8 if face.get_char_index(c) else fs * 4
+		return advance, 0, advance
+
+class FontRunsTest(unittest.TestCase):
+	def setUp(self):
+		self._fonts = converter.FONTS, converter._glyph_metrics
+		converter._glyph_metrics = FakeGlyphMetrics()
+		glyphs = {'Arial': 'abc', 'MS PGothic': 'abc草'}
+		converter.FONTS = OrderedDict(
+			(name, (style, FakeFace(glyphs.get(name, '')), sizes))
+			for name, (style, face, sizes) in converter.load_fonts().items())
+	def tearDown(self):
+		converter.FONTS, converter._glyph_metrics = self._fonts
+
+	def test_font_for(self):
+		self.assertEqual(converter.font_for('a', None), 'Arial')
+		self.assertEqual(converter.font_for('草', 'Arial'), 'MS PGothic')
+		warnings = []
+		self.assertIsNone(converter.font_for('\U0001f600', None, warnings))
+		self.assertEqual(warnings, ['fonts'])
+
+	def test_chars_skip_characters_in_no_font(self):
+		runs = converter._font_runs('a草\U0001f600b', converter.SIZE)
+		self.assertEqual(dict(runs.chars), {'Arial': frozenset('ab'),
+		                                    'MS PGothic': frozenset('草')})
+		self.assertEqual(runs.warnings, ('fonts',))
+
+	def test_measure(self):
+		F = converter.Fraction
+		# Arial is 27 pixels at size 24 and MS PGothic 24, and the line is
+		# as tall as the taller font; the outline adds 1 on each side
+		self.assertEqual(converter.measure('ab', 24), (54 + 2, 27 + 2))
+		self.assertEqual(converter.measure('草', 24), (24 + 2, 24 + 2))
+		self.assertEqual(converter.measure('a草b', 24), (78 + 2, 27 + 2))
+		# A character in no font is drawn as a missing glyph in Arial
+		self.assertEqual(converter.measure('\U0001f600', 24),
+		                 (F(27, 2) + 2, 27 + 2))
+		self.assertEqual(converter.measure('草\U0001f600', 24),
+		                 (24 + F(27, 2) + 2, 27 + 2))
+		# A single font is used as is, even for what it lacks
+		self.assertEqual(converter.measure('草a\U0001f600', 36,
+		                                   'MS PGothic', 0),
+		                 (36 + 36 + 18, 36))
+
+# Operator comments only, so that no text needs the fonts
+LAYOUT_CHATS = [
+	'/perm a{b}c',
+	'/foo bar',
+	'/vote start "Question" yes no',
+	'/vote showresult whatever 600 400',
+	'/vote stop',
+	'/perm second',
+]
+
+class ReadTest(unittest.TestCase):
+	PACKET = (b'<packet><chat thread="1" no="1" vpos="0" date="1484047270" '
+	          b'user_id="u">hi</chat></packet>\n')
+
+	def read(self, data):
+		chats = list(converter.read_chats(io.BytesIO(data),
+		                                  converter.Config()))
+		stream = list(converter.read_stream(io.BytesIO(data),
+		                                    converter.Config(), poll=60))
+		self.assertEqual([chat.text for chat in stream],
+		                 [chat.text for chat in chats])
+		return chats
+
+	def test_packet(self):
+		self.assertEqual([chat.text for chat in self.read(self.PACKET + b'\n')],
+		                 ['hi'])
+
+	def test_junk_after_packet(self):
+		for junk in (b'junk\n', b'<packet></packet>\n'):
+			file = io.BytesIO(self.PACKET + junk)
+			with self.assertRaises(converter.ElementTree.ParseError):
+				list(converter.read_chats(file, converter.Config()))
+			# Not waiting for more once the packet is closed
+			file.seek(0)
+			with self.assertRaises(converter.ElementTree.ParseError):
+				list(converter.read_stream(file, converter.Config(), poll=60))
+
+class LayoutTest(unittest.TestCase):
+	def setUp(self):
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.directory = directory.name
+		self.xml = self.path('comments.xml')
+		with open(self.xml, 'w', encoding='utf-8') as file:
+			file.write('<packet>\n')
+			for i, text in enumerate(LAYOUT_CHATS):
+				file.write('<chat thread="1" no="%d" vpos="%d" date="%d" '
+				           'premium="3" user_id="u">%s</chat>\n' %
+				           (i + 1, i * 500, 1484047270 + i * 5, text))
+			file.write('</packet>\n')
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	def convert(self, pass_number, settings={}, **options):
+		output = io.StringIO()
+		with contextlib.redirect_stderr(io.StringIO()) as errors:
+			converter.convert(self.xml, output,
+			                  converter.Config(pass_number=pass_number,
+			                                   **settings),
+			                  bounds=self.path('bounds.txt'),
+			                  bounds_cache=self.path('cache.txt'),
+			                  **options)
+		return output.getvalue(), errors.getvalue()
+
+	def measure(self, settings={}):
+		# Run PASS 1 and stand in for rendering its output
+		self.convert(1, settings)
+		with open(self.path('bounds.keys'), encoding='utf-8') as file:
+			count = len(file.read().splitlines())
+		with open(self.path('bounds.txt'), 'w', encoding='utf-8') as file:
+			file.writelines('%d 300 30\n' % i for i in range(count))
+		return count
+
+	def test_round_trip(self):
+		self.measure()
+		script, errors = self.convert(2, layout=self.path('layout.json'))
+		warnings = set(converter.unsupported)
+		self.assertIn('commands', warnings)
+		self.assertIn('result_modes', warnings)
+		self.assertEqual(converter.unsupported_commands, {'foo'})
+
+		output = io.StringIO()
+		with contextlib.redirect_stderr(io.StringIO()) as layout_errors:
+			converter.render_layout(self.path('layout.json'), output)
+		self.assertEqual(output.getvalue(), script)
+		self.assertEqual(sorted(layout_errors.getvalue().splitlines()),
+		                 sorted(errors.splitlines()))
+		self.assertEqual(converter.unsupported, warnings)
+		self.assertEqual(converter.unsupported_commands, {'foo'})
+
+	def test_cache_misses_other_config(self):
+		count = self.measure()
+		self.convert(2)
+		font_files = converter.FONT_FILES.copy()
+		font_files['MS PGothic'] = 'msgothic.ttc'
+		for settings in ({'scale': 10}, {'font_files': font_files}):
+			with self.assertRaises(SystemExit):
+				self.convert(2, settings)
+			self.assertEqual(self.measure(settings), count)
+			self.convert(2, settings)
+		self.convert(2)
+
+	def test_invalid_files(self):
+		path = self.path('layout.json')
+		for content in ('', '[]', '{"format": "niconico-to-ass layout"}',
+		                '{"$fraction": [1, 0]}', '\x80\x04K.'):
+			with open(path, 'w', encoding='utf-8') as file:
+				file.write(content)
+			with self.assertRaises(ValueError):
+				converter.load_layout(path)
+
+class RenderTest(unittest.TestCase):
+	def render(self, chat, config):
+		output = io.StringIO()
+		sink = converter.Sink(output)
+		converter.render_chat(chat, config, sink, defaultdict(set))
+		sink.close()
+		return output.getvalue().splitlines()
+
+	def test_perm_follows_config(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'comments.xml')
+			with open(path, 'w', encoding='utf-8') as file:
+				file.write('<packet>\n<chat thread="1" no="1" vpos="0" '
+				           'date="1484047270" premium="3" user_id="u">'
+				           '/perm hello</chat>\n</packet>\n')
+			config = converter.Config(width=800, height=450)
+			chat, = converter.load_chats(path, config)
+		converter.resolve_timing([chat])
+		chat.width, chat.height = converter.Fraction(1000), converter.Fraction(30)
+		box, middle, text = self.render(chat, config)
+		center = r'\pos(%s,%s)' % (config.x(400), config.y(28))
+		self.assertIn(center + r'\p1}m 0 0 l 10400 0 10400 728 0 728', box)
+		self.assertIn(center + r'\p1}m 0 0 l 10374 0 10374 700 0 700', middle)
+		# Shrunk to fit the width and centered across it
+		self.assertIn(r'{\pos(%s,%s)\fscx79\fscy79}hello' %
+		              (config.x(5), config.y(28)), text)
+
+		# A rendition at another scale draws the same boxes
+		box, middle, text = self.render(chat, config.replace(scale=10))
+		self.assertIn(r'\p1}m 0 0 l 8000 0 8000 560 0 560', box)
+		self.assertIn(r'\p1}m 0 0 l 7980 0 7980 538 0 538', middle)
+
+def write_danmaku(path, count, rate, seed=0):
+	"""write_danmaku(path, count, rate, seed=0)
+
+Write a comment XML file of count plain danmaku arriving at rate per
+second, with a mix of positions and sizes."""
+	r = random.Random(seed)
+	time = 0
+	with open(path, 'w', encoding='utf-8') as file:
+		file.write('<packet>\n')
+		for i in range(count):
+			time += r.expovariate(rate)
+			mail = ' '.join(filter(None, (r.choice(['', '', 'ue', 'shita']),
+			                              r.choice(['', '', 'big', 'small']))))
+			file.write('<chat thread="1" no="%d" vpos="%d" date="%d" '
+			           'mail="%s" user_id="u%d">%s</chat>\n' %
+			           (i + 1, round(time * 100), 1484047270 + int(time),
+			            mail, i % 50, 'w' * r.randrange(1, 30)))
+		file.write('</packet>\n')
+
+def load_danmaku(path, config):
+	# Stand in for measuring with the fonts: 8 pixels per character
+	chats = converter.load_chats(path, config)
+	converter.resolve_timing(chats)
+	for chat in chats:
+		chat.width = converter.Fraction(8 * len(chat.text) * chat.size, 24)
+	return chats
+
+class PriorityTest(unittest.TestCase):
+	def chat(self, premium=0, mail=None):
+		return converter.Chat('w', converter.Config(), thread='1',
+		                      date='1484047270', user_id='u', mail=mail,
+		                      premium=str(premium))
+
+	def test_staff_premium_normal(self):
+		staff = self.chat(converter.Chat._STAFF, 'small')
+		premium = self.chat(converter.Chat._PREMIUM, 'small')
+		normal = self.chat()
+		chats = sorted([normal, premium, staff],
+		               key=converter.danmaku_priority, reverse=True)
+		self.assertEqual(chats, [staff, premium, normal])
+		# Size only decides among chats that are otherwise equal
+		self.assertGreater(converter.danmaku_priority(self.chat()),
+		                   converter.danmaku_priority(self.chat(mail='small')))
+
+class ShardTest(unittest.TestCase):
+	def test_sharded_layout_is_sequential_layout(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'comments.xml')
+			write_danmaku(path, 3000, 15)
+			config = converter.Config(seed=1)
+			sequential = load_danmaku(path, config)
+			sharded = load_danmaku(path, config)
+		converter.lay_out(sequential, config)
+		danmaku = list(enumerate(sharded))
+		for n, chat in danmaku:
+			converter.position(chat, config)
+		converter.counters.clear()
+		converter.lay_out_sharded(danmaku, config, 2, shard=20, margin=5)
+		# The seams must have been reconciled for the test to mean much
+		self.assertTrue(converter.counters['chats laid out again'])
+		self.assertEqual([(chat.y, chat.alpha) for chat in sharded],
+		                 [(chat.y, chat.alpha) for chat in sequential])
+
+if __name__ == '__main__':
+	unittest.main()